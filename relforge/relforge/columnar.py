@@ -0,0 +1,305 @@
+# columnar.py - Columnar storage for search results and query rows
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+# http://www.gnu.org/copyleft/gpl.html
+
+import json
+import logging
+import numbers
+import os
+import shutil
+
+import numpy as np
+
+from relforge.runner import openResults
+
+
+LOG = logging.getLogger(__name__)
+
+
+class StringColumn(object):
+    """A column of strings packed into one utf-8 buffer
+
+    String i is the bytes between offsets[i] and offsets[i + 1] of data.
+    This avoids a python object per value, and lets the column be saved
+    and memory mapped like any other numpy array. When the column has
+    None values nulls is a boolean array marking them.
+    """
+
+    # Number of strings decoded per block when iterating
+    BLOCK_SIZE = 65536
+
+    def __init__(self, data, offsets, nulls=None):
+        self.data = data
+        self.offsets = offsets
+        self.nulls = nulls
+
+    @classmethod
+    def from_strings(cls, strings):
+        strings = list(strings)
+        nulls = None
+        if any(s is None for s in strings):
+            nulls = np.array([s is None for s in strings], dtype=bool)
+            strings = ['' if s is None else s for s in strings]
+        encoded = [s.encode('utf8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(data, offsets, nulls)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.nulls is not None and self.nulls[i]:
+            return None
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf8')
+
+    def __iter__(self):
+        # Strings are decoded a block at a time, so a memory mapped column
+        # is only ever read into memory one block of bytes at a time.
+        for lo in range(0, len(self), self.BLOCK_SIZE):
+            hi = min(lo + self.BLOCK_SIZE, len(self))
+            offsets = self.offsets[lo:hi + 1]
+            base = int(offsets[0])
+            buf = self.data[base:int(offsets[-1])].tobytes()
+            offsets = (offsets - base).tolist()
+            if self.nulls is None:
+                for start, end in zip(offsets[:-1], offsets[1:]):
+                    yield buf[start:end].decode('utf8')
+            else:
+                for start, end, null in zip(offsets[:-1], offsets[1:], self.nulls[lo:hi].tolist()):
+                    yield None if null else buf[start:end].decode('utf8')
+
+    def tolist(self):
+        return list(self)
+
+
+def save_columns(path, columns):
+    """Save a dict of numpy arrays and StringColumns into directory path"""
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    for name, column in columns.items():
+        if isinstance(column, StringColumn):
+            np.save(os.path.join(path, name + '.data.npy'), column.data)
+            np.save(os.path.join(path, name + '.offsets.npy'), column.offsets)
+            if column.nulls is not None:
+                np.save(os.path.join(path, name + '.nulls.npy'), column.nulls)
+        else:
+            np.save(os.path.join(path, name + '.npy'), column)
+
+
+def load_columns(path, mmap=True):
+    """Load the columns saved by save_columns
+
+    With mmap the arrays are memory mapped read-only instead of being
+    read into memory.
+    """
+    mmap_mode = 'r' if mmap else None
+    columns = {}
+    for filename in os.listdir(path):
+        name, ext = os.path.splitext(filename)
+        if ext != '.npy' or name.endswith('.offsets') or name.endswith('.nulls'):
+            continue
+        if name.endswith('.data'):
+            name = name[:-len('.data')]
+            nulls_path = os.path.join(path, name + '.nulls.npy')
+            columns[name] = StringColumn(
+                np.load(os.path.join(path, name + '.data.npy'), mmap_mode=mmap_mode),
+                np.load(os.path.join(path, name + '.offsets.npy'), mmap_mode=mmap_mode),
+                np.load(nulls_path, mmap_mode=mmap_mode) if os.path.exists(nulls_path) else None)
+        else:
+            columns[name] = np.load(os.path.join(path, filename), mmap_mode=mmap_mode)
+    return columns
+
+
+def column_from_values(values):
+    """Pack a list of values into a numpy array or StringColumn
+
+    Integers become an int64 array, other numbers (with None as NaN) a
+    float64 array and anything else a StringColumn of the values as
+    strings.
+    """
+    def is_number(v):
+        return isinstance(v, numbers.Number) and not isinstance(v, bool)
+
+    if all(is_number(v) and isinstance(v, numbers.Integral) for v in values):
+        return np.array(values, dtype=np.int64)
+    if all(v is None or is_number(v) for v in values):
+        return np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)
+    return StringColumn.from_strings(None if v is None else v if isinstance(v, str) else str(v) for v in values)
+
+
+def columns_from_rows(rows, num_columns=0):
+    """Transpose an iterable of row tuples into a list of columns"""
+    values = None
+    for row in rows:
+        if values is None:
+            values = [[] for _ in row]
+        for column, value in zip(values, row):
+            column.append(value)
+    if values is None:
+        values = [[] for _ in range(num_columns)]
+    return [column_from_values(column) for column in values]
+
+
+def iter_rows(columns):
+    """Iterate over columns as tuples of python values"""
+    return zip(*[column if isinstance(column, StringColumn) else column.tolist() for column in columns])
+
+
+def save_table(path, columns):
+    """Save a list of columns into directory path
+
+    The table is written to a temporary directory and moved into place,
+    so a partially written table is never loaded.
+    """
+    tmp_path = path + '.tmp'
+    save_columns(tmp_path, dict(('c%d' % (i), column) for i, column in enumerate(columns)))
+    with open(os.path.join(tmp_path, 'table.json'), 'w') as f:
+        json.dump({'num_columns': len(columns)}, f)
+    _replace_dir(tmp_path, path)
+
+
+def _replace_dir(tmp_path, path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def load_table(path, mmap=True):
+    """Load the list of columns saved by save_table"""
+    with open(os.path.join(path, 'table.json')) as f:
+        num_columns = json.load(f)['num_columns']
+    columns = load_columns(path, mmap)
+    return [columns['c%d' % (i)] for i in range(num_columns)]
+
+
+class ColumnarResults(object):
+    """Search results decoded once into flat columns
+
+    Per query there is the query string, totalHits and whether the search
+    errored. Hits of all queries are stored in one table, ordered by query
+    and rank, with hit_offsets[i]:hit_offsets[i + 1] being the hits of
+    query i.
+    """
+    QUERY_COLUMNS = ['queries', 'total_hits', 'errors', 'hit_offsets']
+    HIT_COLUMNS = ['doc_ids', 'titles', 'scores']
+
+    def __init__(self, columns):
+        for name in self.QUERY_COLUMNS + self.HIT_COLUMNS:
+            setattr(self, name, columns[name])
+
+    @classmethod
+    def from_json_lines(cls, json_lines):
+        queries = []
+        total_hits = []
+        errors = []
+        hit_offsets = [0]
+        doc_ids = []
+        titles = []
+        scores = []
+        for line in json_lines:
+            decoded = json.loads(line)
+            queries.append(decoded['query'])
+            if 'error' in decoded:
+                LOG.warning('Error in result: %s', line)
+                errors.append(True)
+                total_hits.append(0)
+            else:
+                errors.append(False)
+                total_hits.append(decoded.get('totalHits', 0))
+                for hit in decoded['rows']:
+                    try:
+                        # Cirrus
+                        doc_ids.append(str(hit['docId']))
+                    except KeyError:
+                        # Wikidata
+                        doc_ids.append(str(hit['pageId']))
+                    titles.append(hit['title'])
+                    scores.append(hit.get('score', np.nan))
+            hit_offsets.append(len(doc_ids))
+        return cls({
+            'queries': StringColumn.from_strings(queries),
+            'total_hits': np.array(total_hits, dtype=np.int64),
+            'errors': np.array(errors, dtype=bool),
+            'hit_offsets': np.array(hit_offsets, dtype=np.int64),
+            'doc_ids': StringColumn.from_strings(doc_ids),
+            'titles': StringColumn.from_strings(titles),
+            'scores': np.array(scores, dtype=np.float64),
+        })
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return cls(load_columns(path, mmap))
+
+    @classmethod
+    def for_results_file(cls, results_path):
+        """Columnar form of a runSearch results file
+
+        The columns are built on first use and saved alongside the results
+        file, later calls memory map the saved columns.
+        """
+        path = results_path + '.columns'
+        if os.path.isdir(path) and os.path.getmtime(path) >= os.path.getmtime(results_path):
+            LOG.debug('Loading columnar results from %s', path)
+            return cls.load(path)
+        with openResults(results_path) as f:
+            results = cls.from_json_lines(f)
+        results.save(path)
+        return results
+
+    def save(self, path):
+        """Save the columns into directory path
+
+        Like save_table the columns are written to a temporary directory
+        first, so an interrupted save never leaves a partial directory
+        at path.
+        """
+        tmp_path = path + '.tmp'
+        save_columns(tmp_path, dict((name, getattr(self, name)) for name in self.QUERY_COLUMNS + self.HIT_COLUMNS))
+        _replace_dir(tmp_path, path)
+
+    def __len__(self):
+        return len(self.queries)
+
+    @property
+    def num_hits(self):
+        """Number of hits returned for each query"""
+        return np.diff(self.hit_offsets)
+
+    @property
+    def hit_query_idx(self):
+        """Index of the query each hit belongs to"""
+        return np.repeat(np.arange(len(self)), self.num_hits)
+
+    @property
+    def hit_ranks(self):
+        """0-indexed rank of each hit within its query"""
+        return np.arange(len(self.doc_ids)) - np.repeat(self.hit_offsets[:-1], self.num_hits)
+
+    def to_results(self):
+        """Results as a dict from query to list of {docId, title} hits"""
+        results = {}
+        doc_ids = self.doc_ids.tolist()
+        titles = self.titles.tolist()
+        offsets = self.hit_offsets.tolist()
+        for i, query in enumerate(self.queries):
+            if query in results:
+                raise Exception('Duplicate result sets for {}'.format(query))
+            results[query] = [{'docId': doc_id, 'title': title}
+                              for doc_id, title in zip(doc_ids[offsets[i]:offsets[i + 1]],
+                                                       titles[offsets[i]:offsets[i + 1]])]
+        LOG.debug('Loaded %d results', len(results))
+        return results
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 # http://www.gnu.org/copyleft/gpl.html
 
+from abc import ABCMeta, abstractmethod
 import codecs
 try:
     # py 3.x
@@ -22,25 +23,32 @@ except ImportError:
     # py 2.x
     import ConfigParser as configparser
 import hashlib
+import itertools
 import logging
 import os
+import numpy as np
 import pandas as pd
-import pickle
+from pandas.api.types import union_categoricals
 import pipes
+try:
+    # py 3.x
+    import queue
+except ImportError:
+    # py 2.x
+    import Queue as queue
+import sqlite3
 import subprocess
+import tempfile
+import threading
 import yaml
 
-
 try:
-    # py 2.x
-    unicode()
+    import pymysql
+    import pymysql.cursors
+except ImportError:
+    pymysql = None
 
-    def decode_unicode_bytes(x):
-        return x.decode('utf-8')
-except NameError:
-    # py 3.x
-    def decode_unicode_bytes(x):
-        return x
+from relforge.columnar import StringColumn, columns_from_rows, iter_rows, load_table, save_table
 
 LOG = logging.getLogger(__name__)
 
@@ -113,37 +121,78 @@ class Hive(object):
         if prefix is not None:
             raise Exception('Malformed input without \\0 terminator: {}'.format(repr(line)))
 
-    def parse(self, cmd_output):
+    def parse_tsv2_block(self, lines):
+        """Parse a block of tsv2 lines, dropping lines with NULL values
+
+        Lines without a \0 quoted column, which is nearly all of them, are
+        split directly. The whole block is checked for \0 at once so the
+        quoting only costs anything when it is actually present.
+        """
+        if '\0' not in '\n'.join(lines):
+            rows = [line.split('\t') for line in lines]
+            if not any('NULL' in row for row in rows):
+                return rows
+            has_nulls = ['NULL' in row for row in rows]
+        else:
+            rows = []
+            has_nulls = []
+            for line in lines:
+                if '\0' in line:
+                    row = list(self.parse_tsv2_line(line))
+                    has_nulls.append(None in row)
+                else:
+                    row = line.split('\t')
+                    has_nulls.append('NULL' in row)
+                rows.append(row)
+        parsed = []
+        for line, row, has_null in zip(lines, rows, has_nulls):
+            if has_null:
+                LOG.debug('Throwing out line with null values: %s', repr(line))
+            else:
+                parsed.append(row)
+        return parsed
+
+    def parse(self, cmd_output, block_size=10000):
         # Beeline isn't made for this, so we get some mediocre output
         # to parse through. If we could pass the command instead of
         # piping it in it would be slightly better, but have length
         # problems.
-        # Guess what the prompt looks like from the first line
-        prompt = cmd_output.pop().split('>', 1)[0] + '> '
+        cmd_output = iter(cmd_output)
+        # Guess what the prompt looks like from the first line, which
+        # echoes the piped in query
+        try:
+            first_line = next(cmd_output)
+        except StopIteration:
+            return
+        prompt = first_line.split('>', 1)[0] + '> '
         LOG.debug('Detected prompt as: %s', prompt)
-        in_results = False
         for line in cmd_output:
-            has_prompt = line.startswith(prompt)
-            if has_prompt:
-                if in_results:
-                    LOG.debug('Found junk, stop looking: %s', line)
-                    return
-                else:
-                    # Junk at beginning
-                    # Probably not the header we are looking for?
-                    LOG.debug('skipping line: %s', line)
-                    continue
-            elif in_results:
-                cols = list(self.parse_tsv2_line(line))
-                if any(x is None for x in cols):
-                    LOG.debug('Throwing out line with null values: %s', repr(line))
-                else:
-                    LOG.debug('Yielding query row: %s', cols)
-                    yield cols
+            if line.startswith(prompt):
+                # Junk at beginning
+                # Probably not the header we are looking for?
+                LOG.debug('skipping line: %s', line)
             else:
                 header = list(self.parse_tsv2_line(line))
                 LOG.debug('Found results section with header: %s', header)
-                in_results = True
+                break
+        else:
+            return
+        # Results are decoded block_size lines at a time. Any line
+        # starting with the prompt is junk following the results.
+        while True:
+            block = list(itertools.islice(cmd_output, block_size))
+            if not block:
+                return
+            text = '\n' + '\n'.join(block)
+            junk_pos = text.find('\n' + prompt)
+            if junk_pos >= 0:
+                junk = text.count('\n', 0, junk_pos + 1) - 1
+                LOG.debug('Found junk, stop looking: %s', block[junk])
+                block = block[:junk]
+            for row in self.parse_tsv2_block(block):
+                yield row
+            if junk_pos >= 0:
+                return
 
 
 class DummyProvider(object):
@@ -187,8 +236,9 @@ class MySql(object):
         return command
 
     def parse(self, cmd_output):
+        cmd_output = iter(cmd_output)
         # burn the header
-        cmd_output.pop(0)
+        next(cmd_output, None)
         for line in cmd_output:
             if len(line) == 0:
                 continue
@@ -198,13 +248,285 @@ class MySql(object):
             yield query, title, float(score)
 
 
-def execute_remote(remote_host, cli_command, input):
+# Base class with ABCMeta as its metaclass, in a way both python 2 and 3 honour
+_ABC = ABCMeta('_ABC', (object,), {})
+
+
+class DbApi(_ABC):
+    """Base for providers reading rows through a DB-API driver
+
+    Instead of running a command on a remote host and parsing its text
+    output, the query is executed directly and rows, already typed by the
+    driver, are read from the cursor batch_size at a time.
+    """
+    batch_size = 10000
+
+    @abstractmethod
+    def connect(self):
+        """Open a DB-API connection to the database"""
+
+    def cursor(self, conn):
+        return conn.cursor()
+
+    def fetch_batches(self, query, batch_size=None):
+        """Yield lists of row tuples as they are read from the cursor"""
+        conn = self.connect()
+        try:
+            cursor = self.cursor(conn)
+            try:
+                cursor.execute(query)
+                while True:
+                    rows = cursor.fetchmany(batch_size or self.batch_size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def fetch(self, query):
+        for rows in self.fetch_batches(query):
+            for row in rows:
+                yield row
+
+
+class MySqlDb(DbApi):
+    """MySQL through pymysql, with an unbuffered server side cursor"""
+    def __init__(self, config):
+        config = config['mysqldb']
+        self.connect_args = {
+            'host': config.get('dbserver', 'localhost'),
+            'port': int(config.get('port', 3306)),
+            'user': config.get('user'),
+            'password': config.get('password') or '',
+            'database': config.get('database'),
+            'read_default_file': config.get('defaults-extra-file'),
+            'charset': 'utf8mb4',
+        }
+
+    def connect(self):
+        if pymysql is None:
+            raise ValueError('The mysqldb provider requires the pymysql package')
+        args = dict((k, v) for k, v in self.connect_args.items() if v is not None)
+        return pymysql.connect(**args)
+
+    def cursor(self, conn):
+        return conn.cursor(pymysql.cursors.SSCursor)
+
+
+class Sqlite(DbApi):
+    """A local sqlite database, mostly as a stand in for MySQL"""
+    def __init__(self, config):
+        self.database = config['sqlite']['database']
+
+    def connect(self):
+        return sqlite3.connect(self.database)
+
+
+class ProcessGroup(object):
+    """Remote commands run on behalf of one fetch
+
+    Lets the fetch kill every command still running from another thread,
+    including ones blocked waiting on output.
+    """
+    def __init__(self):
+        self._processes = set()
+        self._killed = False
+        self._lock = threading.Lock()
+
+    def add(self, p):
+        with self._lock:
+            self._processes.add(p)
+            if self._killed:
+                p.kill()
+
+    def remove(self, p):
+        with self._lock:
+            self._processes.discard(p)
+
+    def kill(self):
+        with self._lock:
+            self._killed = True
+            for p in self._processes:
+                if p.poll() is None:
+                    p.kill()
+
+
+def stream_remote(remote_host, cli_command, input, processes=None):
+    """Run cli_command on remote_host, yielding its output line by line
+
+    Lines are decoded as they arrive, lines that are not valid utf-8 are
+    logged and skipped. stderr is collected in a temporary file so it
+    can't block the command, and is reported once the output ends. The
+    command is added to the ProcessGroup processes while it runs.
+    """
     command = cli_command.to_shell_string()
-    p = subprocess.Popen(['ssh', '-o', 'Compression=yes', remote_host, command],
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
+    with tempfile.TemporaryFile() as stderr:
+        p = subprocess.Popen(['ssh', '-o', 'Compression=yes', remote_host, command],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=stderr)
+        if processes is not None:
+            processes.add(p)
+        num_lines = 0
+        try:
+            p.stdin.write(input)
+            p.stdin.close()
+            for line in p.stdout:
+                try:
+                    decoded = line.decode('utf-8')
+                except UnicodeDecodeError:
+                    # Some unknown problem ... throw out bad data :(
+                    LOG.debug("Non-utf8 data: %s", line)
+                    continue
+                num_lines += 1
+                yield decoded.rstrip('\n')
+            p.wait()
+        finally:
+            if p.poll() is None:
+                # The caller stopped reading early
+                p.kill()
+                p.wait()
+            p.stdout.close()
+            if processes is not None:
+                processes.remove(p)
+        stderr.seek(0)
+        errors = stderr.read().decode('utf-8', 'replace')
+    if num_lines == 0:
+        raise RuntimeError("Couldn't run SQL query:\n%s" % (errors))
+    if len(errors):
+        LOG.debug('query stderr: %s', errors)
+
+
+def fetch_concurrent(fetches, concurrency, processes=None, batch_size=1000, max_batches=100):
+    """Merge the rows of several fetches run by concurrency threads
+
+    fetches is a list of (fn, args) where fn(*args) iterates rows. Rows
+    are passed back in batches through a bounded queue, so fast fetches
+    wait on the consumer rather than buffering their results. The first
+    error raised by a fetch is raised to the consumer. When the consumer
+    stops early or on error the remote commands of the fetches, tracked
+    by the ProcessGroup processes, are killed rather than waited on.
+    """
+    pending = queue.Queue()
+    for fetch in fetches:
+        pending.put(fetch)
+    batches = queue.Queue(max_batches)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-    return p.communicate(input=input)
+    def worker():
+        try:
+            while not stop.is_set():
+                try:
+                    fn, args = pending.get_nowait()
+                except queue.Empty:
+                    break
+                rows = iter(fn(*args))
+                try:
+                    while True:
+                        batch = list(itertools.islice(rows, batch_size))
+                        if batch and not put(batch):
+                            return
+                        if len(batch) < batch_size:
+                            break
+                finally:
+                    if hasattr(rows, 'close'):
+                        rows.close()
+        except Exception as e:
+            if not stop.is_set():
+                # Otherwise it was killed after the consumer stopped
+                LOG.exception('Fetch failed')
+                put(e)
+        finally:
+            put(done)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(concurrency, len(fetches))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            item = batches.get()
+            if item is done:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                for row in item:
+                    yield row
+    finally:
+        stop.set()
+        if processes is not None:
+            # Unblocks workers waiting on a quiet remote command
+            processes.kill()
+        for thread in threads:
+            thread.join()
+
+
+def typed_column(values, pd_type=None):
+    """Convert a sequence of values to an array of the pandas type pd_type
+
+    category gives a Categorical, datetime types a datetime64 array and
+    numeric types a numpy array of that type. Without a type, or for
+    string types, values are kept as python objects.
+    """
+    if pd_type is None or pd_type in ('str', 'object', 'string'):
+        return np.array(values, dtype=object)
+    if pd_type == 'category':
+        return pd.Categorical(values)
+    if str(pd_type).startswith('datetime64'):
+        return pd.to_datetime(values).values
+    try:
+        return np.array(values, dtype=np.dtype(pd_type))
+    except (TypeError, ValueError):
+        return pd.Series(values, dtype=object).astype(pd_type).values
+
+
+class DataFrameBuilder(object):
+    """Build a DataFrame from chunks of rows
+
+    Each chunk is transposed and its columns converted to their type from
+    types straight away, so values only live as python objects for one
+    chunk. The typed chunks are concatenated by build, categoricals with
+    union_categoricals to keep them categorical.
+    """
+    def __init__(self, columns=None, types=None):
+        self.columns = columns
+        self.types = types or {}
+        self._chunks = None
+
+    def add_rows(self, rows):
+        values = list(zip(*rows))
+        if self.columns is None:
+            self.columns = list(range(len(values)))
+        if len(values) != len(self.columns):
+            raise ValueError('Expected {} columns but rows have {}'.format(len(self.columns), len(values)))
+        if self._chunks is None:
+            self._chunks = [[] for _ in self.columns]
+        for chunks, name, column in zip(self._chunks, self.columns, values):
+            chunks.append(typed_column(column, self.types.get(name)))
+
+    def build(self):
+        columns = self.columns or []
+        data = {}
+        for i, name in enumerate(columns):
+            chunks = self._chunks[i] if self._chunks else [typed_column([], self.types.get(name))]
+            if isinstance(chunks[0], pd.Categorical):
+                data[name] = union_categoricals(chunks) if len(chunks) > 1 else chunks[0]
+            else:
+                data[name] = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+        return pd.DataFrame(data, columns=columns)
 
 
 class Query(object):
@@ -212,78 +534,142 @@ class Query(object):
         'mysql': MySql,
         'hive': Hive,
         'dummy': DummyProvider,
+        'mysqldb': MySqlDb,
+        'sqlite': Sqlite,
     }
 
     def __init__(self, settings):
         with codecs.open(settings('query'), "r", "utf-8") as f:
-            sql_config = yaml.load(f.read())
+            sql_config = yaml.load(f.read(), Loader=yaml.Loader)
 
         try:
             preferred_host = settings('host')
         except configparser.NoOptionError:
-            server = sql_config['servers'][0]
+            servers = sql_config['servers']
+            server = servers[0]
         else:
             server = self._choose_server(sql_config['servers'], preferred_host)
+            servers = [server]
 
         self.columns = sql_config.get('columns', None)
         self.types = sql_config.get('types', {})
         self._remote_host = server['host']
-        self.provider = self.PROVIDERS[sql_config['provider']](server)
+        self.provider_name = sql_config['provider']
+        self.provider = self.PROVIDERS[self.provider_name](server)
         self.scoring_config = sql_config['scoring']
         sql_config['variables'].update(settings())
-        self._query = sql_config['query'].format(**sql_config['variables'])
+        partitions = sql_config.get('partitions')
+        if partitions:
+            self._partitions = self._partition_queries(sql_config, partitions, servers)
+            self._concurrency = int(partitions.get('concurrency', len(self._partitions)))
+            self._query = '\n'.join(query for _, query in self._partitions)
+        else:
+            self._query = sql_config['query'].format(**sql_config['variables'])
+            self._partitions = [(server, self._query)]
+            self._concurrency = 1
         LOG.debug('Loaded SQL query: %s', self._query)
 
+    def _partition_queries(self, sql_config, partitions, servers):
+        """One (server, query) pair per value of the partition variable
+
+        Partitions are spread round robin over the servers.
+        """
+        if 'values' in partitions:
+            values = partitions['values']
+        else:
+            values = range(*partitions['range'])
+        variable = partitions['variable']
+        queries = []
+        for i, value in enumerate(values):
+            variables = dict(sql_config['variables'], **{variable: value})
+            queries.append((servers[i % len(servers)], sql_config['query'].format(**variables)))
+        if not queries:
+            raise RuntimeError('No values for partition variable %s' % (variable))
+        return queries
+
     def _choose_server(self, servers, host):
         for server in servers:
             if server['host'] == host:
                 return server
         raise RuntimeError("Couldn't locate host %s" % (host))
 
-    def to_df(self):
-        df = pd.DataFrame(self.fetch(), columns=self.columns)
-        for column, pd_type in self.types.items():
-            df[column] = df[column].astype(pd_type)
-        return df
+    def to_df(self, chunk_size=100000):
+        """Fetch the rows into a DataFrame
+
+        Rows are converted to typed columns chunk_size at a time, so only
+        one chunk of rows is held as python objects at once.
+        """
+        builder = DataFrameBuilder(self.columns, self.types)
+        for chunk in self._fetch_chunks(chunk_size):
+            builder.add_rows(chunk)
+        return builder.build()
+
+    def _fetch_chunks(self, chunk_size):
+        """Yield the rows of the query in lists of up to chunk_size rows"""
+        server, query = self._partitions[0]
+        if len(self._partitions) == 1 and isinstance(self.provider, DbApi):
+            # Batches come straight from the cursor
+            for chunk in self.provider.fetch_batches(query, chunk_size):
+                yield chunk
+            return
+        rows = iter(self.fetch())
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                break
 
     def fetch(self):
-        cli_command = self.provider.commandline()
-        stdout, stderr = execute_remote(
-                self._remote_host, cli_command, self._query.encode('utf8'))
-        if len(stdout) == 0:
-            raise RuntimeError("Couldn't run SQL query:\n%s" % (stderr))
-        if len(stderr):
-            LOG.debug('query stderr: %s', stderr)
+        """Yield the rows of the query as they arrive
 
-        try:
-            output = decode_unicode_bytes(stdout).split("\n")
-        except UnicodeDecodeError:
-            # Some unknown problem ... let's just work through it line by line
-            # and throw out bad data :(
-            output = []
-            for line in stdout.split("\n"):
-                try:
-                    output.append(decode_unicode_bytes(line))
-                except UnicodeDecodeError:
-                    LOG.debug("Non-utf8 data: %s", line)
-        return self.provider.parse(output)
+        A partitioned query runs its partitions concurrently, and yields
+        rows of all partitions in the order they arrive.
+        """
+        if len(self._partitions) == 1:
+            # The only partition runs on the server self.provider was made for
+            server, query = self._partitions[0]
+            return self._fetch_partition(server, query, provider=self.provider)
+        processes = ProcessGroup()
+        return fetch_concurrent(
+            [(self._fetch_partition, (server, query, processes)) for server, query in self._partitions],
+            self._concurrency, processes)
+
+    def _fetch_partition(self, server, query, processes=None, provider=None):
+        if provider is None:
+            provider = self.PROVIDERS[self.provider_name](server)
+        if isinstance(provider, DbApi):
+            return provider.fetch(query)
+        return self._parse_remote(provider, server, query, processes)
+
+    def _parse_remote(self, provider, server, query, processes=None):
+        lines = stream_remote(server['host'], provider.commandline(), query.encode('utf8'), processes)
+        for row in provider.parse(lines):
+            yield row
 
 
 class CachedQuery(Query):
+    """Query with its result rows cached under workDir
+
+    The rows are stored as columns, numpy arrays for numeric columns and
+    packed strings for the rest, in a directory keyed by the provider and
+    a hash of the query. Later fetches memory map the saved columns
+    rather than running the query again.
+    """
     def __init__(self, settings):
         super(CachedQuery, self).__init__(settings)
-        self._cache_dir = os.path.join(settings('workDir'), '/cache')
+        self._cache_dir = os.path.join(settings('workDir'), 'cache', 'query')
         query_hash = hashlib.md5(self._query.encode('utf8')).hexdigest()
-        self._cache_path = os.path.join(self._cache_dir, query_hash + '.pkl')
+        self._cache_path = os.path.join(self._cache_dir, '%s-%s' % (self.provider_name, query_hash))
 
-    def fetch(self):
+    def fetch_columns(self):
+        """The result rows as a list of columns"""
         try:
-            with codecs.open(self._cache_path, 'r', 'utf-8') as f:
-                return pickle.load(f)
-        except IOError:
+            return load_table(self._cache_path)
+        except (IOError, OSError):
             LOG.debug("No cached query result available.")
 
-        result = super(CachedQuery, self).fetch()
+        columns = columns_from_rows(super(CachedQuery, self).fetch(), len(self.columns or []))
 
         if not os.path.isdir(self._cache_dir):
             try:
@@ -292,6 +678,22 @@ class CachedQuery(Query):
                 LOG.debug("cache directory created since checking")
                 pass
 
-        with codecs.open(self._cache_path, 'w', 'utf-8') as f:
-            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
-        return result
+        save_table(self._cache_path, columns)
+        return load_table(self._cache_path)
+
+    def fetch(self):
+        return iter_rows(self.fetch_columns())
+
+    def to_df(self):
+        columns = self.fetch_columns()
+        names = self.columns or list(range(len(columns)))
+        data = {}
+        for name, column in zip(names, columns):
+            pd_type = self.types.get(name)
+            if isinstance(column, StringColumn):
+                data[name] = typed_column(column.tolist(), pd_type)
+            elif pd_type is None:
+                data[name] = np.asarray(column)
+            else:
+                data[name] = typed_column(column, pd_type)
+        return pd.DataFrame(data, columns=names)
@@ -13,6 +13,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 # http://www.gnu.org/copyleft/gpl.html
 
+import gzip
+import io
 import os
 import pipes
 import shutil
@@ -20,6 +22,23 @@ import subprocess
 import re
 import json
 import base64
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
+import math
+import threading
+
+import elasticsearch
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSIONS = [None, 'gzip', 'zstd']
 
 
 def defaults(config, section, settings):
@@ -45,53 +64,731 @@ def getSafeWorkPath(config, section, subdir):
     return os.path.join(config.get('settings', 'workdir'), subdir, qname)
 
 
-def sanitize_json(file):
-    file_isjson = file + '.isjson'
-    file_isnotjson = file + '.isnotjson'
-    isjson = open(file_isjson, 'w')
-    isnotjson = open(file_isnotjson, 'w')
-    for line in open(file).readlines():
-        if line.startswith('{'):
+def detectCompression(head):
+    """Detect the compression of data from its first few bytes"""
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def checkCompression(compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression %s, expected one of %s' % (compression, COMPRESSIONS))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression requires the zstandard package')
+
+
+def compressBlock(data, compression):
+    checkCompression(compression)
+    if compression == 'gzip':
+        return gzip.compress(data)
+    elif compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompressBlock(data):
+    compression = detectCompression(data)
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    elif compression == 'zstd':
+        checkCompression(compression)
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def openResults(path, mode='r', compression=None):
+    """Open a results file, transparently (de)compressing it
+
+    When reading the compression is detected from the file contents, when
+    writing `compression` is one of None, 'gzip' or 'zstd'. Data is
+    streamed through the (de)compressor so memory use stays flat. Text
+    modes read and write utf-8.
+    """
+    if mode[0] == 'r':
+        with open(path, 'rb') as f:
+            compression = detectCompression(f.read(4))
+    checkCompression(compression)
+    raw_mode = mode[0] + 'b'
+    if compression == 'gzip':
+        f = gzip.open(path, raw_mode)
+    elif compression == 'zstd':
+        raw = open(path, raw_mode)
+        if mode[0] == 'r':
+            f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True))
+        else:
+            f = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    else:
+        f = open(path, raw_mode)
+    if 'b' in mode:
+        return f
+    return io.TextIOWrapper(f, encoding='utf8')
+
+
+def splitJsonLines(lines, isjson, isnotjson):
+    """Route each line of bytes to isjson or isnotjson as it is read"""
+    for line in lines:
+        if line.startswith(b'{'):
             isjson.write(line)
         else:
             isnotjson.write(line)
-    isjson.close()
-    isnotjson.close()
+
+
+def sanitize_json(file):
+    file_isjson = file + '.isjson'
+    file_isnotjson = file + '.isnotjson'
+    with open(file, 'rb') as lines, open(file_isjson, 'wb') as isjson, \
+            open(file_isnotjson, 'wb') as isnotjson:
+        splitJsonLines(lines, isjson, isnotjson)
     shutil.move(file_isjson, file)
     if os.path.getsize(file_isnotjson) == 0:
         os.remove(file_isnotjson)
 
 
+class ResultCache(object):
+    """Append-only store of search results for a single search setup
+
+    Results are stored one JSON line per query in `results`, with an
+    `index` file mapping each query string to the block holding its line
+    and the position of the line within the block. Lines are written in
+    blocks of about BLOCK_SIZE bytes, each compressed on its own when
+    `compression` is set, which compresses far better than single lines
+    while keeping entries addressable. Later entries for the same query
+    replace earlier ones, and compact() drops the replaced entries from
+    disk.
+    """
+    BLOCK_SIZE = 256 * 1024
+
+    def __init__(self, cache_dir, compression=None):
+        checkCompression(compression)
+        self.cache_dir = cache_dir
+        self.compression = compression
+        self.results_path = os.path.join(cache_dir, 'results')
+        self.index_path = os.path.join(cache_dir, 'index')
+        self.lock_path = os.path.join(cache_dir, 'lock')
+        self._results = None
+        self._index_file = None
+        self._pending = []
+        self._pending_size = 0
+        self._block = (None, None)
+        self._load_index()
+
+    def _load_index(self):
+        """Read the index
+
+        Entries are numbered in the order they were added, and carry their
+        number in the index so numbers stay stable when compact() drops
+        replaced entries. Indexes written before lines were grouped into
+        blocks hold one line per block and number entries implicitly.
+        """
+        self.entries = 0
+        self._index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                for line in f:
+                    try:
+                        fields = line.decode('utf8').rstrip('\n').split('\t')
+                        if len(fields) == 3:
+                            offset, length, query = fields
+                            entry, line_offset, line_length = self.entries, 0, None
+                        elif len(fields) == 4:
+                            offset, length, entry, query = fields
+                            line_offset, line_length = 0, None
+                        else:
+                            offset, length, line_offset, line_length, entry, query = fields
+                            line_offset, line_length = int(line_offset), int(line_length)
+                        entry = int(entry)
+                        self._index[json.loads(query)] = (entry, int(offset), int(length), line_offset, line_length)
+                    except ValueError:
+                        # Partial entry left behind by an interrupted run
+                        continue
+                    self.entries = max(self.entries, entry + 1)
+
+    def __contains__(self, query):
+        return query in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def entry(self, query):
+        """Sequence number of the cache entry holding the result for query"""
+        return self._index[query][0]
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        """Hold a lock on the cache directory with an up to date index"""
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Created by another process since checking
+                pass
+        with open(self.lock_path, 'ab') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                if os.path.isfile(self.results_path + '.tmp') or os.path.isfile(self.index_path + '.tmp'):
+                    # Left behind by an interrupted compaction, which needs
+                    # the exclusive lock to clean up after.
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    self._finishCompaction()
+                    fcntl.flock(lock, operation)
+                self._load_index()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def appending(self):
+        """Hold the cache open for add()
+
+        An exclusive lock on the cache directory is held throughout, so
+        processes sharing the cache don't interleave their appends. The
+        index is reloaded once the lock is held to pick up entries added
+        by other processes in the meantime.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            needs_newline = False
+            if os.path.isfile(self.index_path) and os.path.getsize(self.index_path) > 0:
+                with open(self.index_path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    needs_newline = f.read(1) != b'\n'
+            with open(self.results_path, 'ab') as results, open(self.index_path, 'ab') as index:
+                if needs_newline:
+                    index.write(b'\n')
+                results.seek(0, os.SEEK_END)
+                self._results = results
+                self._index_file = index
+                try:
+                    yield self
+                finally:
+                    self.flush()
+                    self._results = None
+                    self._index_file = None
+
+    @contextlib.contextmanager
+    def reading(self):
+        """Open the results for copyResult()
+
+        A shared lock is held so the cache can't be compacted, moving
+        results around, while they are being read.
+        """
+        with self._locked(fcntl.LOCK_SH), self.open() as f:
+            yield f
+
+    def add(self, query, line):
+        """Add a result line, writing it to disk once its block fills up"""
+        if not line.endswith(b'\n'):
+            line += b'\n'
+        self._pending.append((query, line, self.entries))
+        self._pending_size += len(line)
+        self.entries += 1
+        if self._pending_size >= self.BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write out the block of lines added since the last flush"""
+        if not self._pending:
+            return
+        block = b''.join(line for _, line, _ in self._pending)
+        data = compressBlock(block, self.compression)
+        offset = self._results.tell()
+        self._results.write(data)
+        self._results.flush()
+        index = []
+        line_offset = 0
+        for query, line, entry in self._pending:
+            index.append('%d\t%d\t%d\t%d\t%d\t%s\n' % (
+                offset, len(data), line_offset, len(line), entry, json.dumps(query)))
+            self._index[query] = (entry, offset, len(data), line_offset, len(line))
+            line_offset += len(line)
+        self._index_file.write(''.join(index).encode('utf8'))
+        self._index_file.flush()
+        self._pending = []
+        self._pending_size = 0
+
+    def _readLine(self, f, query):
+        _, offset, length, line_offset, line_length = self._index[query]
+        # Results are mostly read in the order they were added, so keeping
+        # the last block around saves decompressing it for every line.
+        if self._block[0] != (f, offset):
+            f.seek(offset)
+            self._block = ((f, offset), decompressBlock(f.read(length)))
+        block = self._block[1]
+        if line_length is None:
+            return block
+        return block[line_offset:line_offset + line_length]
+
+    def copyResult(self, f, query, out):
+        """Copy the result for query from f, as returned by open(), to out"""
+        writeLine(self._readLine(f, query), out)
+
+    def open(self):
+        if os.path.isfile(self.results_path):
+            return open(self.results_path, 'rb')
+        return open(os.devnull, 'rb')
+
+    def compact(self, min_replaced=0.5):
+        """Drop entries replaced by a later entry for the same query
+
+        Nothing is done unless at least min_replaced of the entries on
+        disk have been replaced. Returns True when the cache was rewritten.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            if not os.path.isfile(self.index_path):
+                return False
+            with open(self.index_path, 'rb') as f:
+                on_disk = sum(1 for _ in f)
+            if on_disk == 0 or on_disk - len(self._index) < on_disk * min_replaced:
+                return False
+            entries = self.entries
+            with open(self.results_path, 'rb') as src, \
+                    open(self.results_path + '.tmp', 'wb') as results, \
+                    open(self.index_path + '.tmp', 'wb') as index_file:
+                # Surviving lines are regrouped into full blocks
+                self._results = results
+                self._index_file = index_file
+                try:
+                    for query, value in sorted(self._index.items(), key=lambda x: x[1][0]):
+                        self.entries = value[0]
+                        self.add(query, self._readLine(src, query))
+                    self.flush()
+                finally:
+                    self._results = None
+                    self._index_file = None
+                    self._block = (None, None)
+                    self.entries = entries
+                for f in (results, index_file):
+                    f.flush()
+                    os.fsync(f.fileno())
+            # Results are swapped in first. If interrupted before the index
+            # follows the next lock holder finishes the job, see
+            # _finishCompaction.
+            os.rename(self.results_path + '.tmp', self.results_path)
+            os.rename(self.index_path + '.tmp', self.index_path)
+            return True
+
+    def _finishCompaction(self):
+        """Recover from a compaction interrupted part way through"""
+        if not os.path.isfile(self.index_path + '.tmp'):
+            if os.path.isfile(self.results_path + '.tmp'):
+                os.remove(self.results_path + '.tmp')
+        elif os.path.isfile(self.results_path + '.tmp'):
+            # Nothing was swapped in yet, the old files are intact
+            os.remove(self.results_path + '.tmp')
+            os.remove(self.index_path + '.tmp')
+        else:
+            # The compacted results are in place, only the index is missing
+            os.rename(self.index_path + '.tmp', self.index_path)
+
+
+class ResultCheckpoint(object):
+    """Thread-safe sink adding each streamed result line to a ResultCache
+
+    Results are added to the cache as they arrive so an interrupted run
+    keeps the completed queries, up to the last block the cache was still
+    filling if the process is killed outright. Errors are held back from the cache so
+    they get retried, and lines that aren't a result for a requested query
+    are kept so they still make it into the results file.
+    """
+
+    def __init__(self, cache, requested):
+        self.cache = cache
+        self.requested = requested
+        self.errors = {}
+        self.unrequested = []
+        self.unknown = []
+        self._lock = threading.Lock()
+
+    def write(self, line):
+        try:
+            decoded = json.loads(line.decode('utf8'))
+            query = decoded['query']
+        except (ValueError, KeyError, TypeError):
+            with self._lock:
+                self.unknown.append(line)
+            return
+        with self._lock:
+            if 'error' in decoded:
+                self.errors[query] = line
+            else:
+                self.cache.add(query, line)
+            if query not in self.requested:
+                self.unrequested.append(query)
+
+
+class LockedWriter(object):
+    """Serialize writes to a file object shared between threads"""
+
+    def __init__(self, f):
+        self.f = f
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self.f.write(data)
+
+
+def writeLine(line, out):
+    out.write(line if line.endswith(b'\n') else line + b'\n')
+
+
+def resultCacheKey(identity):
+    """Hash everything that determines the result returned for a query"""
+    key = json.dumps(identity, sort_keys=True)
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+class SshBackend(object):
+    """Pipe queries through searchCommand on labHost
+
+    The search command, typically CirrusSearch's runSearch.php, reads one
+    query per line on stdin and writes one JSON result per line.
+    """
+    required_settings = ['labHost', 'searchCommand']
+
+    def __init__(self, config, section, search_options):
+        self.lab_host = config.get(section, 'labHost')
+        self.cmdline = config.get(section, 'searchCommand')
+        self.search_options = search_options
+
+    def cache_key(self):
+        options = None if self.search_options is None else json.loads(self.search_options)
+        return [self.lab_host, self.cmdline, options]
+
+    def run(self, queries_file, isjson, isnotjson):
+        cmdline = self.cmdline
+        if self.search_options is not None:
+            cmdline += " --options " + "B64://" + \
+                base64.b64encode(self.search_options.encode('utf8')).decode('ascii')
+        streamSearch(queries_file, self.lab_host, cmdline, isjson, isnotjson)
+
+
+class ElasticsearchBackend(object):
+    """Send dumped CirrusSearch query bodies straight to elasticsearch
+
+    Each line of the queryDumps file is the cirrusDumpQuery output for the
+    query on the same line of the queries file. Bodies are sent in _msearch
+    batches of msearchBatchSize over the pooled connections of a single
+    client, and responses are formatted like runSearch.php output. Search
+    config options are already baked into the dumps and are ignored.
+    """
+    required_settings = ['esHosts', 'queryDumps']
+
+    def __init__(self, config, section, search_options):
+        self.hosts = config.get(section, 'esHosts').split(',')
+        self.index = config.get(section, 'esIndex') if config.has_option(section, 'esIndex') else None
+        self.batch_size = config.getint(section, 'msearchBatchSize') \
+            if config.has_option(section, 'msearchBatchSize') else 100
+        if search_options is not None:
+            print("WARNING: search config for [%s] is ignored by the elasticsearch backend" % (section))
+        self.dumps_path = config.get(section, 'queryDumps')
+        # Map each query to the offset of its dump rather than holding all
+        # the query bodies in memory.
+        self._dumps = {}
+        dumps_hash = hashlib.sha1()
+        with openResults(config.get(section, 'queries')) as queries, open(self.dumps_path, 'rb') as dumps:
+            offset = 0
+            for query, dump in zip(queries, dumps):
+                self._dumps[query.rstrip('\n')] = offset
+                offset += len(dump)
+                dumps_hash.update(dump)
+        self._dumps_hash = dumps_hash.hexdigest()
+        shards = config.getint(section, 'shards') if config.has_option(section, 'shards') else 1
+        self.client = elasticsearch.Elasticsearch(self.hosts, maxsize=max(10, shards))
+
+    def cache_key(self):
+        return ['elasticsearch', self.hosts, self.index, self._dumps_hash]
+
+    def _request(self, dump):
+        dump = json.loads(dump.decode('utf8'))
+        # Cirrus nests the dump of the main search request when it
+        # also dumps secondary requests.
+        dump = dump.get('__main__', dump)
+        index, _ = dump['path'].split('/', 1)
+        header = {'index': self.index or index}
+        if 'search_type' in dump.get('params', {}):
+            header['search_type'] = dump['params']['search_type']
+        return header, dump['query']
+
+    def _msearch(self, queries, dumps, isjson):
+        body = []
+        for query in queries:
+            dumps.seek(self._dumps[query])
+            body.extend(self._request(dumps.readline()))
+        for query, response in zip(queries, self.client.msearch(body=body)['responses']):
+            writeLine(json.dumps(formatSearchResponse(query, response)).encode('utf8'), isjson)
+
+    def run(self, queries_file, isjson, isnotjson):
+        with open(queries_file) as queries, open(self.dumps_path, 'rb') as dumps:
+            batch = []
+            for line in queries:
+                query = line.rstrip('\n')
+                if query not in self._dumps:
+                    error = {'query': query, 'error': 'No query dump available'}
+                    writeLine(json.dumps(error).encode('utf8'), isjson)
+                    continue
+                batch.append(query)
+                if len(batch) >= self.batch_size:
+                    self._msearch(batch, dumps, isjson)
+                    batch = []
+            if batch:
+                self._msearch(batch, dumps, isjson)
+
+
+def formatSearchResponse(query, response):
+    """Convert an elasticsearch search response into a runSearch.php result"""
+    if 'error' in response:
+        return {'query': query, 'error': response['error']}
+    rows = []
+    for hit in response['hits']['hits']:
+        row = {
+            'docId': hit['_id'],
+            'title': hit.get('_source', {}).get('title'),
+            'score': hit.get('_score'),
+        }
+        if '_explanation' in hit:
+            row['explanation'] = hit['_explanation']
+        rows.append(row)
+    return {'query': query, 'totalHits': response['hits']['total'], 'rows': rows}
+
+
+BACKENDS = {
+    'ssh': SshBackend,
+    'elasticsearch': ElasticsearchBackend,
+}
+
+
+def getBackend(config, section):
+    """Class of the search backend configured for section"""
+    name = config.get(section, 'backend') if config.has_option(section, 'backend') else 'ssh'
+    return BACKENDS[name]
+
+
+_cache_locks = {}
+_cache_locks_lock = threading.Lock()
+
+
+def cacheLock(cache_dir):
+    """Lock serializing runs within this process that share a result cache"""
+    with _cache_locks_lock:
+        if cache_dir not in _cache_locks:
+            _cache_locks[cache_dir] = threading.Lock()
+        return _cache_locks[cache_dir]
+
+
+def readSearchOptions(config, section):
+    """The search options json of a section, or None if it has none"""
+    if not config.has_option(section, 'config'):
+        return None
+    try:
+        # validate json
+        json.loads(config.get(section, 'config'))
+        return config.get(section, 'config')
+    except ValueError:
+        # config wasn't valid json, maybe it was a file containing json
+        with open(config.get(section, 'config')) as f:
+            return f.read()
+
+
 def runSearch(config, section, allow_reuse=True):
     qdir = getSafeWorkPath(config, section, 'queries')
-    cmdline = config.get(section, 'searchCommand')
+    if config.has_option(section, 'allowReuse'):
+        allow_reuse = allow_reuse and config.getboolean(section, 'allowReuse')
 
     results_file = qdir + '/results'
-    if os.path.isfile(results_file) and allow_reuse:
-        print("REUSING: %s" % results_file)
-        return results_file
+    checkpoint_file = qdir + '/checkpoint'
+    # The checkpoint of an interrupted run must survive clearing out the dir
+    checkpoint = {}
+    if os.path.isfile(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
     refreshDir(qdir)
-    if config.has_option(section, 'config'):
-        try:
-            # validate json
-            json.loads(config.get(section, 'config'))
-            search_options = config.get(section, 'config')
-        except ValueError:
-            # config wasn't valid json, maybe it was a file containing json
-            with open(config.get(section, 'config')) as f:
-                search_options = f.read()
+    search_options = readSearchOptions(config, section)
+    if search_options is not None:
         with open(qdir + '/config.json', 'w') as f:
             f.write(search_options)  # archive search config
-        search_options = "B64://" + base64.b64encode(search_options.encode('utf8')).decode('ascii')
-        cmdline += " --options " + search_options
-    runCommand("cat %s | ssh %s %s > %s" % (config.get(section, 'queries'),
-                                            config.get(section, 'labHost'),
-                                            pipes.quote(cmdline),
-                                            results_file))
-    shutil.copyfile(config.get(section, 'queries'), qdir + '/queries')  # archive queries
-    # sanitize json
-    sanitize_json(results_file)
-    return results_file
+    compression = config.get(section, 'compression') if config.has_option(section, 'compression') else None
+    backend = getBackend(config, section)(config, section, search_options)
+    cache_key = resultCacheKey(backend.cache_key())
+    cache_dir = os.path.join(config.get('settings', 'workDir'), 'cache', 'results', cache_key)
+    # Sections sharing a cache take turns, so later ones reuse the results
+    # of the first rather than racing it.
+    with cacheLock(cache_dir):
+        cache = ResultCache(cache_dir, compression)
+
+        # Results added to the cache since an interrupted run started are always
+        # usable, which lets runs that don't allow reuse resume too.
+        if checkpoint.get('cache') == cache_key:
+            start = checkpoint['start']
+            print("RESUMING: from cache entry %d" % (start))
+        else:
+            start = cache.entries
+        with open(checkpoint_file, 'w') as f:
+            json.dump({'cache': cache_key, 'start': start}, f)
+
+        def usable(query):
+            return query in cache and (allow_reuse or cache.entry(query) >= start)
+
+        with openResults(config.get(section, 'queries'), 'rb') as f, \
+                openResults(qdir + '/queries', 'wb', compression) as archive:
+            shutil.copyfileobj(f, archive)  # archive queries
+        with openResults(config.get(section, 'queries')) as f:
+            queries = [line.rstrip('\n') for line in f]
+        requested = set(queries)
+        pending = []
+        seen = set()
+        for query in queries:
+            if not usable(query) and query not in seen:
+                pending.append(query)
+                seen.add(query)
+        print("REUSING: %d of %d results from %s" % (len(queries) - len(pending), len(queries), cache.cache_dir))
+
+        fresh = ResultCheckpoint(cache, requested)
+        if pending:
+            pending_file = qdir + '/queries.pending'
+            with open(pending_file, 'w') as f:
+                f.write(''.join(query + '\n' for query in pending))
+            shards = config.getint(section, 'shards') if config.has_option(section, 'shards') else 1
+            with cache.appending(), open(results_file + '.isnotjson', 'wb') as isnotjson:
+                runSharded(backend, pending_file, fresh, LockedWriter(isnotjson), shards)
+            os.remove(pending_file)
+            if os.path.getsize(results_file + '.isnotjson') == 0:
+                os.remove(results_file + '.isnotjson')
+
+        # Assemble the results in the original query order
+        with openResults(results_file, 'wb', compression) as out, cache.reading() as cached:
+            for query in queries:
+                if query in fresh.errors:
+                    writeLine(fresh.errors[query], out)
+                elif usable(query):
+                    cache.copyResult(cached, query, out)
+            # Results that don't echo back a requested query string can't be
+            # looked up by query, but shouldn't be lost either.
+            for query in fresh.unrequested:
+                if query in fresh.errors:
+                    writeLine(fresh.errors[query], out)
+                else:
+                    cache.copyResult(cached, query, out)
+            for line in fresh.unknown:
+                writeLine(line, out)
+        os.remove(checkpoint_file)
+        # Re-running queries leaves their old results behind in the cache
+        cache.compact()
+        return results_file
+
+
+def runSearches(config, sections, allow_reuse=True, concurrency=None):
+    """Run the searches for several sections concurrently
+
+    At most concurrency searches, all of them by default, run at once.
+    Yields (section, results_file) tuples as each search completes, so
+    callers can start using results while other searches are running.
+    Failures are reported as they happen, and the first one is re-raised
+    once every search has finished.
+    """
+    errors = []
+    max_workers = max(1, min(concurrency or len(sections), len(sections)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict((executor.submit(runSearch, config, section, allow_reuse), section)
+                       for section in sections)
+        for future in concurrent.futures.as_completed(futures):
+            section = futures[future]
+            try:
+                results_file = future.result()
+            except Exception as e:
+                print("FAILED: [%s] %s" % (section, e))
+                errors.append(e)
+                continue
+            print("COMPLETED: [%s] %s" % (section, results_file))
+            yield section, results_file
+    if errors:
+        raise errors[0]
+
+
+def splitQueries(queries_file, shards, shard_dir):
+    """Split a queries file into at most `shards` contiguous chunks
+
+    Returns the list of chunk paths in their original order.
+    """
+    with open(queries_file) as f:
+        queries = f.readlines()
+    chunk_size = max(1, int(math.ceil(len(queries) / float(shards))))
+    paths = []
+    for start in range(0, len(queries), chunk_size):
+        path = os.path.join(shard_dir, 'queries.%d' % (len(paths)))
+        with open(path, 'w') as f:
+            f.writelines(queries[start:start + chunk_size])
+        paths.append(path)
+    return paths
+
+
+def searchCommandLine(queries_file, lab_host, cmdline):
+    """Build the shell pipeline feeding queries to the search command
+
+    A lab host of `localhost` runs the search command directly instead of
+    going through ssh.
+    """
+    if lab_host == 'localhost':
+        return "cat %s | %s" % (queries_file, cmdline)
+    return "cat %s | ssh %s %s" % (queries_file, lab_host, pipes.quote(cmdline))
+
+
+def streamSearch(queries_file, lab_host, cmdline, isjson, isnotjson):
+    """Run the search command, splitting its output as it arrives
+
+    JSON lines are written to the isjson file object and anything else
+    to isnotjson, so the output never has to be held in memory or
+    rewritten afterwards.
+    """
+    cmd = searchCommandLine(queries_file, lab_host, cmdline)
+    print("RUNNING " + cmd)
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    try:
+        splitJsonLines(proc.stdout, isjson, isnotjson)
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def runSharded(backend, queries_file, isjson, isnotjson, shards=1):
+    """Run the queries through backend with `shards` concurrent workers
+
+    JSON results are written to isjson and any other output to isnotjson
+    as it arrives. Each shard gets a contiguous chunk of the queries file,
+    and all shards write to the same isjson and isnotjson, so those must
+    be safe to use from multiple threads.
+    """
+    if shards <= 1:
+        backend.run(queries_file, isjson, isnotjson)
+        return
+    shard_dir = queries_file + '.shards'
+    refreshDir(shard_dir)
+    try:
+        errors = []
+
+        def run_shard(path):
+            try:
+                backend.run(path, isjson, isnotjson)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run_shard, args=(path,))
+                   for path in splitQueries(queries_file, shards, shard_dir)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+    finally:
+        shutil.rmtree(shard_dir)
 
 
 def checkSettings(config, section, settings):
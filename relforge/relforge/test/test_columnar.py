@@ -0,0 +1,101 @@
+import json
+
+import numpy as np
+import pytest
+
+from relforge.columnar import ColumnarResults, StringColumn, load_columns, save_columns
+
+
+RESULTS = [
+    {'query': 'foo', 'totalHits': 12, 'rows': [
+        {'docId': '1', 'title': 'Foo', 'score': 3.0},
+        {'docId': '2', 'title': u'Föö', 'score': 2.0},
+    ]},
+    {'query': 'error', 'error': 'timeout'},
+    {'query': 'wikidata', 'totalHits': 1, 'rows': [
+        {'pageId': 42, 'title': 'Q42'},
+    ]},
+    {'query': 'nothing', 'totalHits': 0, 'rows': []},
+]
+
+
+def make_results():
+    return ColumnarResults.from_json_lines(json.dumps(r) for r in RESULTS)
+
+
+@pytest.mark.parametrize('strings', [
+    [],
+    [''],
+    ['a', '', u'été', 'tab\there'],
+    [None, 'a', None],
+])
+@pytest.mark.parametrize('block_size', [2, 65536])
+def test_string_column(tmpdir, monkeypatch, strings, block_size):
+    monkeypatch.setattr(StringColumn, 'BLOCK_SIZE', block_size)
+    column = StringColumn.from_strings(strings)
+    assert len(column) == len(strings)
+    assert column.tolist() == strings
+    assert [column[i] for i in range(len(strings))] == strings
+    save_columns(str(tmpdir.join('cols')), {'s': column, 'n': np.arange(3)})
+    loaded = load_columns(str(tmpdir.join('cols')))
+    assert loaded['s'].tolist() == strings
+    assert loaded['n'].tolist() == [0, 1, 2]
+
+
+def test_columnar_results():
+    results = make_results()
+    assert len(results) == 4
+    assert results.queries.tolist() == ['foo', 'error', 'wikidata', 'nothing']
+    assert results.total_hits.tolist() == [12, 0, 1, 0]
+    assert results.errors.tolist() == [False, True, False, False]
+    assert results.num_hits.tolist() == [2, 0, 1, 0]
+    assert results.hit_query_idx.tolist() == [0, 0, 2]
+    assert results.hit_ranks.tolist() == [0, 1, 0]
+    assert results.doc_ids.tolist() == ['1', '2', '42']
+    assert results.titles.tolist() == ['Foo', u'Föö', 'Q42']
+    assert results.scores[:2].tolist() == [3.0, 2.0]
+    assert np.isnan(results.scores[2])
+
+
+def test_to_results():
+    assert make_results().to_results() == {
+        'foo': [{'docId': '1', 'title': 'Foo'}, {'docId': '2', 'title': u'Föö'}],
+        'error': [],
+        'wikidata': [{'docId': '42', 'title': 'Q42'}],
+        'nothing': [],
+    }
+
+
+def test_to_results_duplicate_query():
+    lines = [json.dumps(RESULTS[0]), json.dumps(RESULTS[0])]
+    with pytest.raises(Exception):
+        ColumnarResults.from_json_lines(lines).to_results()
+
+
+def test_for_results_file(tmpdir):
+    path = str(tmpdir.join('results'))
+    with open(path, 'w') as f:
+        f.write(''.join(json.dumps(r) + '\n' for r in RESULTS))
+    expected = make_results().to_results()
+    assert ColumnarResults.for_results_file(path).to_results() == expected
+    assert tmpdir.join('results.columns').isdir()
+    # Second load comes from the saved columns
+    assert ColumnarResults.for_results_file(path).to_results() == expected
+
+
+def test_for_results_file_interrupted_save(tmpdir, mocker):
+    path = str(tmpdir.join('results'))
+    with open(path, 'w') as f:
+        f.write(''.join(json.dumps(r) + '\n' for r in RESULTS))
+
+    def partial_save(path, columns):
+        # Interrupted after writing only some of the columns
+        save_columns(path, {'queries': columns['queries']})
+        raise KeyboardInterrupt()
+
+    mocker.patch('relforge.columnar.save_columns', side_effect=partial_save)
+    with pytest.raises(KeyboardInterrupt):
+        ColumnarResults.for_results_file(path)
+    assert not tmpdir.join('results.columns').exists()
+    mocker.stopall()
+    assert ColumnarResults.for_results_file(path).to_results() == make_results().to_results()
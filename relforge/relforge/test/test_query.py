@@ -1,7 +1,11 @@
+import configparser
+import os
 import pandas as pd
 import pytest
 import relforge.query
-from relforge.query import CachedQuery, CliCommand, CliSequence, MySql, Query
+from relforge.query import CachedQuery, CliCommand, CliSequence, Hive, MySql, Query, stream_remote
+import subprocess
+import sys
 import tempfile
 import yaml
 
@@ -19,6 +23,8 @@ def make_query(query_class=Query, **kwargs):
             'servers': [{
                 'host': 'pytesthost',
                 'mysql': {},
+                'mysqldb': {},
+                'sqlite': {'database': ':memory:'},
                 'dummy': {
                     'results': []
                 }
@@ -32,7 +38,16 @@ def make_query(query_class=Query, **kwargs):
         }
         f.write(yaml.dump(dict(defaults, **kwargs)))
         f.flush()
-        return query_class(lambda x=None: settings if x is None else settings[x])
+        settings = dict((k, v) for k, v in settings.items() if v is not None)
+
+        def get_setting(x=None):
+            if x is None:
+                return settings
+            try:
+                return settings[x]
+            except KeyError:
+                raise configparser.NoOptionError(x, 'test')
+        return query_class(get_setting)
 
 
 def make_cached_query(**kwargs):
@@ -105,8 +120,8 @@ def test_mysql_provider_parse():
 
 def test_to_df(mocker):
     mocker.patch.object(
-        relforge.query, 'execute_remote',
-        return_value=('some useless text', ''))
+        relforge.query, 'stream_remote',
+        return_value=iter(['some useless text']))
     df = make_query(
         columns=['z', 'y', 'x'],
         servers=[{
@@ -121,3 +136,355 @@ def test_to_df(mocker):
     assert isinstance(df, pd.DataFrame)
     assert df.columns.tolist() == ['z', 'y', 'x']
     assert len(df) == 2
+
+
+def test_cached_query(mocker, tmpdir):
+    execute = mocker.patch.object(
+        relforge.query, 'stream_remote',
+        return_value=iter(['some useless text']))
+    rows = [
+        ('foo', 'Foo', 2.5, 1),
+        (u'b\xe4r', 'NULL', 0., 2),
+        ('baz', '', None, 3),
+    ]
+    kwargs = {
+        'test_settings': {'workDir': str(tmpdir)},
+        'columns': ['query', 'title', 'score', 'n'],
+        'servers': [{'host': 'pytesthost', 'dummy': {'results': rows}}],
+    }
+    q = make_cached_query(**kwargs)
+    fetched = list(q.fetch())
+    assert execute.call_count == 1
+    assert [r[:2] for r in fetched] == [r[:2] for r in rows]
+    assert [r[2] for r in fetched][:2] == [2.5, 0.]
+    assert [r[3] for r in fetched] == [1, 2, 3]
+    assert tmpdir.join('cache', 'query').listdir()[0].basename.startswith('dummy-')
+
+    # A second query with the same sql reads the cache
+    q = make_cached_query(**kwargs)
+    assert [r[:2] + r[3:] for r in q.fetch()] == [r[:2] + r[3:] for r in fetched]
+    assert execute.call_count == 1
+    df = q.to_df()
+    assert df.columns.tolist() == ['query', 'title', 'score', 'n']
+    assert df['n'].tolist() == [1, 2, 3]
+
+
+def fake_ssh(mocker, script):
+    popen = subprocess.Popen
+
+    def run_locally(args, **kwargs):
+        # Run script instead of ssh'ing to the remote host
+        return popen([sys.executable, '-c', script], **kwargs)
+    return mocker.patch.object(relforge.query.subprocess, 'Popen', side_effect=run_locally)
+
+
+def test_stream_remote(mocker):
+    fake_ssh(mocker, """
+import sys
+data = sys.stdin.buffer.read()
+out = sys.stdout.buffer
+out.write(b'first\\n' + b'bad \\xff\\n' + u'\\u00e9t\\u00e9\\n'.encode('utf8') + data)
+sys.stderr.write('some warning')
+""")
+    lines = stream_remote('pytesthost', CliCommand(['mysql']), b'input')
+    assert list(lines) == ['first', u'\u00e9t\u00e9', 'input']
+
+
+def test_stream_remote_no_output(mocker):
+    fake_ssh(mocker, "import sys; sys.stderr.write('access denied')")
+    with pytest.raises(RuntimeError) as excinfo:
+        list(stream_remote('pytesthost', CliCommand(['mysql']), b'input'))
+    assert 'access denied' in str(excinfo.value)
+
+
+def test_hive_provider_parse():
+    provider = Hive({})
+    lines = iter([
+        '0: jdbc:hive2://pytest> SELECT a, b',
+        '0: jdbc:hive2://pytest> FROM t;',
+        'a\tb',
+        'x\ty',
+        'NULL\tz',
+        '\0tab\there\0\tw',
+        '0: jdbc:hive2://pytest> ',
+        'never\tparsed',
+    ])
+    assert list(provider.parse(lines)) == [['x', 'y'], ['tab\there', 'w']]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 100])
+def test_to_df_chunks(mocker, chunk_size):
+    rows = [('q%d' % (i), 't%d' % (i), float(i)) for i in range(5)]
+    df = make_query(
+        columns=['query', 'title', 'score'],
+        types={'score': 'float32'},
+        servers=[{'host': 'pytesthost', 'dummy': {'results': rows}}]).to_df(chunk_size=chunk_size)
+    assert df.index.tolist() == list(range(5))
+    assert df['query'].tolist() == [r[0] for r in rows]
+    assert df['score'].dtype == 'float32'
+
+
+@pytest.mark.parametrize('chunk_size', [2, 10])
+def test_to_df_typed_chunks(mocker, chunk_size):
+    rows = [('2017-10-%02d 00:00:00' % (i + 1), ['a', 'b', 'c'][i % 3], 'q%d' % (i), str(i)) for i in range(7)]
+    df = make_query(
+        columns=['dt', 'context', 'searchTerm', 'clickPage'],
+        types={'dt': 'datetime64', 'context': 'category', 'searchTerm': 'str', 'clickPage': 'int64'},
+        servers=[{'host': 'pytesthost', 'dummy': {'results': rows}}]).to_df(chunk_size=chunk_size)
+    assert str(df['dt'].dtype).startswith('datetime64')
+    assert df['dt'][3] == pd.Timestamp('2017-10-04')
+    assert df['context'].dtype == 'category'
+    assert sorted(df['context'].cat.categories) == ['a', 'b', 'c']
+    assert df['context'].tolist() == [r[1] for r in rows]
+    assert df['searchTerm'].tolist() == [r[2] for r in rows]
+    assert df['clickPage'].dtype == 'int64'
+    assert df['clickPage'].tolist() == list(range(7))
+
+
+def test_to_df_no_rows(mocker):
+    df = make_query(
+        columns=['context', 'clickPage'],
+        types={'context': 'category', 'clickPage': 'int64'},
+        servers=[{'host': 'pytesthost', 'dummy': {'results': []}}]).to_df()
+    assert len(df) == 0
+    assert df.columns.tolist() == ['context', 'clickPage']
+    assert df['clickPage'].dtype == 'int64'
+
+
+def parse_line_by_line(provider, lines):
+    """The line at a time parser Hive.parse replaced, kept for reference"""
+    log = relforge.query.LOG
+    lines = iter(lines)
+    prompt = next(lines).split('>', 1)[0] + '> '
+    log.debug('Detected prompt as: %s', prompt)
+    in_results = False
+    for line in lines:
+        has_prompt = line.startswith(prompt)
+        if has_prompt:
+            if in_results:
+                log.debug('Found junk, stop looking: %s', line)
+                return
+            else:
+                log.debug('skipping line: %s', line)
+                continue
+        elif in_results:
+            cols = list(provider.parse_tsv2_line(line))
+            if any(x is None for x in cols):
+                log.debug('Throwing out line with null values: %s', repr(line))
+            else:
+                log.debug('Yielding query row: %s', cols)
+                yield cols
+        else:
+            header = list(provider.parse_tsv2_line(line))
+            log.debug('Found results section with header: %s', header)
+            in_results = True
+
+
+@pytest.mark.parametrize('block_size', [1, 3, 7, 10000])
+@pytest.mark.parametrize('seed', range(5))
+def test_hive_parse_matches_line_by_line(block_size, seed):
+    import random
+    rng = random.Random(seed)
+    values = ['a', 'b c', '', 'NULL', '0', 'x\0y', '\0tab\there\0', '\0NULL\tz\0']
+    lines = ['0: jdbc:hive2://pytest> select', '0: jdbc:hive2://pytest> junk', 'x\ty\tz']
+    for _ in range(50):
+        lines.append('\t'.join(rng.choice(values) for _ in range(3)))
+    if seed % 2:
+        lines += ['0: jdbc:hive2://pytest> ', 'never\tparsed']
+
+    provider = Hive({})
+    expected = list(parse_line_by_line(provider, lines))
+    assert list(provider.parse(lines, block_size=block_size)) == expected
+
+
+def make_partitioned_query(**kwargs):
+    return make_query(
+        provider='mysql',
+        servers=[{'host': 'host1', 'mysql': {}}, {'host': 'host2', 'mysql': {}}],
+        query='select {day} from {table}',
+        variables={'table': 'clicks'},
+        test_settings={'host': None},
+        **kwargs)
+
+
+def fake_partition_output(remote_host, cli_command, input, processes=None):
+    day = input.decode('utf8').split()[1]
+    return iter(['query\ttitle\tscore'] + ['%s\t%s\t%d' % (day, remote_host, i) for i in range(2500)])
+
+
+@pytest.mark.parametrize('concurrency', [1, 3, 10])
+def test_partitioned_fetch(mocker, concurrency):
+    execute = mocker.patch.object(relforge.query, 'stream_remote', side_effect=fake_partition_output)
+    query = make_partitioned_query(partitions={'variable': 'day', 'range': [1, 6], 'concurrency': concurrency})
+    assert 'select 1 from clicks' in query._query
+    rows = list(query.fetch())
+    assert execute.call_count == 5
+    assert len(rows) == 5 * 2500
+    expected = [('%d' % (day), 'host%d' % (2 - day % 2), float(i)) for day in range(1, 6) for i in range(2500)]
+    assert sorted(rows) == sorted(expected)
+
+
+def test_partitioned_fetch_error(mocker):
+    def fail_on_day_3(remote_host, cli_command, input, processes=None):
+        if b'select 3 ' in input:
+            raise RuntimeError("Couldn't run SQL query")
+        return fake_partition_output(remote_host, cli_command, input, processes)
+
+    mocker.patch.object(relforge.query, 'stream_remote', side_effect=fail_on_day_3)
+    query = make_partitioned_query(partitions={'variable': 'day', 'values': [1, 2, 3], 'concurrency': 2})
+    with pytest.raises(RuntimeError):
+        list(query.fetch())
+
+
+def test_partitioned_fetch_stop_early(mocker):
+    mocker.patch.object(relforge.query, 'stream_remote', side_effect=fake_partition_output)
+    query = make_partitioned_query(partitions={'variable': 'day', 'range': [1, 31], 'concurrency': 4})
+    rows = query.fetch()
+    assert len([row for _, row in zip(range(10), rows)]) == 10
+    rows.close()
+
+
+SLOW_PARTITION = """
+import sys, time
+query = sys.stdin.read()
+if 'select 1 ' in query:
+    print('query\\ttitle\\tscore')
+    # A full batch of rows, then nothing more for a while
+    for _ in range(1000):
+        print('q\\tt\\t1')
+    sys.stdout.flush()
+elif 'select 2 ' in query:
+    sys.exit(1)
+time.sleep(30)
+"""
+
+
+def test_partitioned_fetch_stop_kills_remotes(mocker):
+    import time
+    fake_ssh(mocker, SLOW_PARTITION)
+    query = make_partitioned_query(partitions={'variable': 'day', 'values': [1, 3, 4], 'concurrency': 3})
+    start = time.time()
+    rows = query.fetch()
+    assert next(rows) == ('q', 't', 1.0)
+    rows.close()
+    assert time.time() - start < 10
+
+
+def test_partitioned_fetch_error_kills_remotes(mocker):
+    import time
+    fake_ssh(mocker, SLOW_PARTITION)
+    query = make_partitioned_query(partitions={'variable': 'day', 'values': [2, 3, 4], 'concurrency': 3})
+    start = time.time()
+    with pytest.raises(RuntimeError):
+        list(query.fetch())
+    assert time.time() - start < 10
+
+
+def make_sqlite_query(tmpdir, rows, **kwargs):
+    import sqlite3
+    database = str(tmpdir.join('relevance.db'))
+    conn = sqlite3.connect(database)
+    conn.execute('CREATE TABLE scores (query TEXT, title TEXT, score REAL)')
+    conn.executemany('INSERT INTO scores VALUES (?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+    return make_query(
+        provider='sqlite',
+        servers=[{'host': 'pytesthost', 'sqlite': {'database': database}}],
+        query='SELECT query, title, score FROM scores ORDER BY rowid',
+        **kwargs)
+
+
+class RecordingCursor(object):
+    def __init__(self, cursor, fetches):
+        self.cursor = cursor
+        self.fetches = fetches
+
+    def fetchmany(self, size):
+        rows = self.cursor.fetchmany(size)
+        self.fetches.append((size, len(rows)))
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def test_sqlite_provider_fetch(tmpdir, mocker):
+    rows = [('q%d' % (i), u't\u00e9%d' % (i), i / 2.) for i in range(10)]
+    query = make_sqlite_query(tmpdir, rows)
+    fetches = []
+    mocker.patch.object(query.provider, 'cursor', side_effect=lambda conn: RecordingCursor(conn.cursor(), fetches))
+    query.provider.batch_size = 4
+    assert list(query.fetch()) == rows
+    assert fetches == [(4, 4), (4, 4), (4, 2), (4, 0)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100])
+def test_sqlite_provider_to_df(tmpdir, chunk_size):
+    rows = [('q%d' % (i % 3), 't%d' % (i), None if i == 4 else float(i)) for i in range(10)]
+    df = make_sqlite_query(
+        tmpdir, rows,
+        columns=['query', 'title', 'score'],
+        types={'query': 'category', 'score': 'float32'},
+    ).to_df(chunk_size=chunk_size)
+    assert df['query'].dtype == 'category'
+    assert df['query'].tolist() == [r[0] for r in rows]
+    assert df['score'].dtype == 'float32'
+    assert pd.isnull(df['score'][4])
+    assert df['score'].fillna(-1).tolist() == [-1 if r[2] is None else r[2] for r in rows]
+
+
+def test_sqlite_provider_empty(tmpdir):
+    df = make_sqlite_query(tmpdir, [], columns=['query', 'title', 'score']).to_df()
+    assert len(df) == 0
+    assert df.columns.tolist() == ['query', 'title', 'score']
+
+
+def test_mysqldb_provider_connect_args():
+    provider = Query.PROVIDERS['mysqldb']({'mysqldb': {
+        'dbserver': 'db1', 'user': 'root', 'database': 'relevance'}})
+    assert provider.connect_args['host'] == 'db1'
+    assert provider.connect_args['port'] == 3306
+    assert provider.connect_args['database'] == 'relevance'
+
+
+@pytest.mark.skipif(not os.environ.get('RELFORGE_BENCHMARK'), reason='set RELFORGE_BENCHMARK=1 to run benchmarks')
+def test_hive_parse_benchmark():
+    """Time Hive.parse against the line at a time parser
+
+    Only runs when asked to, run with -s to see the timings, e.g.
+    RELFORGE_BENCHMARK=1 pytest -s -k test_hive_parse_benchmark relforge/test/test_query.py
+    """
+    import gc
+    import timeit
+    lines = ['0: jdbc:hive2://pytest> select', 'dt\tcontext\tlanguage\tsearchTerm\tclickPage']
+    for i in range(100000):
+        if i % 1000 == 0:
+            lines.append('NULL\twbsearch\ten\tterm\t1')
+        elif i % 500 == 0:
+            lines.append('2018-10-01 00:00:00\twbsearch\ten\t\0tab\tterm %d\0\t%d' % (i, i))
+        else:
+            lines.append('2018-10-01 00:00:00\twbsearch\ten\tterm %d\t%d' % (i, i))
+    lines.append('0: jdbc:hive2://pytest> ')
+
+    provider = Hive({})
+    assert list(provider.parse(lines)) == list(parse_line_by_line(provider, lines))
+    timings = {}
+    gc.disable()
+    try:
+        for name, parse in [('line by line', lambda: parse_line_by_line(provider, lines)),
+                            ('blocks', lambda: provider.parse(lines))]:
+            timings[name] = min(timeit.repeat(lambda: sum(1 for _ in parse()), number=1, repeat=3))
+    finally:
+        gc.enable()
+    print('\nHive.parse of %d lines: %s' % (len(lines), ', '.join(
+        '%s %.3fs' % (name, timing) for name, timing in sorted(timings.items()))))
+    assert timings['blocks'] < timings['line by line']
+
+
+def test_db_api_provider_requires_connect():
+    class NoConnect(relforge.query.DbApi):
+        pass
+
+    with pytest.raises(TypeError):
+        NoConnect()
@@ -0,0 +1,473 @@
+try:
+    # py 3.x
+    import configparser
+except ImportError:
+    # py 2.x
+    import ConfigParser as configparser
+import io
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import relforge.runner as runner
+
+
+# Stands in for runSearch.php: echos a result per query and logs what it ran
+FAKE_SEARCH = '''
+import json
+import os
+import sys
+with open(sys.argv[1], 'a') as log:
+    for line in sys.stdin:
+        query = line.rstrip('\\n')
+        log.write(query + '\\n')
+        if query == 'die' and os.path.exists(sys.argv[2]):
+            sys.exit(1)
+        if query.startswith('!'):
+            print(query[1:])
+        else:
+            print(json.dumps({'query': query, 'totalHits': len(query), 'rows': []}))
+'''
+
+
+def make_config(tmpdir, queries, **kwargs):
+    queries_path = str(tmpdir.join('queries.txt'))
+    with open(queries_path, 'w') as f:
+        f.write(''.join(q + '\n' for q in queries))
+    script_path = str(tmpdir.join('fake_search.py'))
+    if not os.path.exists(script_path):
+        with open(script_path, 'w') as f:
+            f.write(FAKE_SEARCH)
+    config = configparser.ConfigParser()
+    config.add_section('settings')
+    config.set('settings', 'workDir', str(tmpdir.join('work')))
+    config.add_section('test1')
+    settings = dict({
+        'name': 'pytest run',
+        'queries': queries_path,
+        'labHost': 'localhost',
+        'searchCommand': '%s %s %s %s' % (sys.executable, script_path, tmpdir.join('ran.log'), tmpdir.join('die')),
+    }, **kwargs)
+    for key, value in settings.items():
+        config.set('test1', key, value)
+    return config
+
+
+@pytest.mark.parametrize('num_queries,shards,expected_chunks', [
+    (10, 1, 1),
+    (10, 3, 3),
+    (10, 10, 10),
+    (3, 10, 3),
+    (0, 4, 0),
+])
+def test_split_queries(tmpdir, num_queries, shards, expected_chunks):
+    queries_path = str(tmpdir.join('queries'))
+    with open(queries_path, 'w') as f:
+        f.write(''.join('q%d\n' % i for i in range(num_queries)))
+    paths = runner.splitQueries(queries_path, shards, str(tmpdir))
+    assert len(paths) == expected_chunks
+    lines = []
+    for path in paths:
+        with open(path) as f:
+            lines.extend(f.readlines())
+    assert lines == ['q%d\n' % i for i in range(num_queries)]
+
+
+def read_lines(path):
+    with runner.openResults(path) as f:
+        return f.read().splitlines()
+
+
+def ran_queries(tmpdir):
+    path = str(tmpdir.join('ran.log'))
+    queries = read_lines(path)
+    os.remove(path)
+    return queries
+
+
+@pytest.mark.parametrize('shards', ['1', '3'])
+def test_run_search_preserves_query_order(tmpdir, shards):
+    queries = ['q%d' % i for i in range(20)] + ['!not json']
+    config = make_config(tmpdir, queries, shards=shards)
+    results_path = runner.runSearch(config, 'test1')
+    assert [json.loads(line)['query'] for line in read_lines(results_path)] == queries[:-1]
+    assert read_lines(results_path + '.isnotjson') == ['not json']
+
+
+def test_run_search_only_runs_uncached_queries(tmpdir):
+    config = make_config(tmpdir, ['a', 'b', 'c'])
+    runner.runSearch(config, 'test1')
+    assert ran_queries(tmpdir) == ['a', 'b', 'c']
+
+    # A renamed test with extra queries reuses the cached results
+    config = make_config(tmpdir, ['d', 'b', 'a', 'e'], name='renamed')
+    results_path = runner.runSearch(config, 'test1')
+    assert ran_queries(tmpdir) == ['d', 'e']
+    assert [json.loads(line)['query'] for line in read_lines(results_path)] == ['d', 'b', 'a', 'e']
+
+
+def test_run_search_cache_is_keyed_by_search_options(tmpdir):
+    config = make_config(tmpdir, ['a', 'b'], config='{"x": 1, "y": 2}')
+    runner.runSearch(config, 'test1')
+    assert ran_queries(tmpdir) == ['a', 'b']
+
+    config = make_config(tmpdir, ['a', 'b'], config='{"y": 2, "x": 1}')
+    runner.runSearch(config, 'test1')
+    assert not os.path.exists(str(tmpdir.join('ran.log')))
+
+    config = make_config(tmpdir, ['a', 'b'], config='{"x": 2}')
+    runner.runSearch(config, 'test1')
+    assert ran_queries(tmpdir) == ['a', 'b']
+
+
+def test_run_search_without_reuse(tmpdir):
+    config = make_config(tmpdir, ['a', 'b'])
+    runner.runSearch(config, 'test1')
+    assert ran_queries(tmpdir) == ['a', 'b']
+    config = make_config(tmpdir, ['a', 'b'], allowReuse='false')
+    runner.runSearch(config, 'test1')
+    assert ran_queries(tmpdir) == ['a', 'b']
+
+
+def test_sanitize_json(tmpdir):
+    path = str(tmpdir.join('results'))
+    with open(path, 'w') as f:
+        f.write('{"query": "a"}\nWarning: junk\n{"query": "b"}\n')
+    runner.sanitize_json(path)
+    assert read_lines(path) == ['{"query": "a"}', '{"query": "b"}']
+    assert read_lines(path + '.isnotjson') == ['Warning: junk']
+
+
+@pytest.mark.parametrize('shards', [1, 2])
+def test_run_sharded_failure(tmpdir, shards):
+    config = make_config(tmpdir, ['a', 'b'], searchCommand='false')
+    backend = runner.SshBackend(config, 'test1', None)
+    with open(str(tmpdir.join('results')), 'wb') as out, pytest.raises(subprocess.CalledProcessError):
+        runner.runSharded(backend, config.get('test1', 'queries'), out, out, shards)
+
+
+@pytest.mark.parametrize('allow_reuse', ['true', 'false'])
+def test_run_search_resumes_interrupted_run(tmpdir, allow_reuse):
+    tmpdir.join('die').write('')
+    config = make_config(tmpdir, ['a', 'b', 'die', 'c'], allowReuse=allow_reuse)
+    with pytest.raises(subprocess.CalledProcessError):
+        runner.runSearch(config, 'test1')
+    assert ran_queries(tmpdir) == ['a', 'b', 'die']
+
+    tmpdir.join('die').remove()
+    results_path = runner.runSearch(config, 'test1')
+    assert ran_queries(tmpdir) == ['die', 'c']
+    assert [json.loads(line)['query'] for line in read_lines(results_path)] == ['a', 'b', 'die', 'c']
+    assert not os.path.exists(os.path.join(os.path.dirname(results_path), 'checkpoint'))
+
+    # Once complete, runs without reuse start over
+    if allow_reuse == 'false':
+        runner.runSearch(config, 'test1')
+        assert ran_queries(tmpdir) == ['a', 'b', 'die', 'c']
+
+
+def test_result_cache_ignores_partial_index_entry(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    cache = runner.ResultCache(cache_dir)
+    with cache.appending():
+        cache.add('a', b'{"query": "a"}')
+    with open(cache.index_path, 'ab') as f:
+        f.write(b'123\t4')
+    cache = runner.ResultCache(cache_dir)
+    assert len(cache) == 1
+    with cache.appending():
+        cache.add('b', b'{"query": "b"}\n')
+    cache = runner.ResultCache(cache_dir)
+    assert len(cache) == 2
+    out = io.BytesIO()
+    with cache.open() as f:
+        cache.copyResult(f, 'b', out)
+    assert out.getvalue() == b'{"query": "b"}\n'
+
+
+def make_es_config(tmpdir, queries, **kwargs):
+    dumps_path = str(tmpdir.join('dumps.jsonl'))
+    with open(dumps_path, 'w') as f:
+        for query in queries:
+            f.write(json.dumps({
+                'description': 'full_text search for %s' % (query),
+                'path': 'testwiki_content/page/_search',
+                'params': {'search_type': 'dfs_query_then_fetch'},
+                'query': {'query': {'match': {'all': query}}},
+            }) + '\n')
+    return make_config(tmpdir, queries, **dict({
+        'backend': 'elasticsearch',
+        'esHosts': 'localhost:9200',
+        'queryDumps': dumps_path,
+    }, **kwargs))
+
+
+def fake_msearch(body):
+    responses = []
+    for header, request in zip(body[::2], body[1::2]):
+        assert header == {'index': 'testwiki_content', 'search_type': 'dfs_query_then_fetch'}
+        query = request['query']['match']['all']
+        if query == 'broken':
+            responses.append({'error': {'type': 'query_shard_exception'}})
+            continue
+        responses.append({'hits': {'total': 2, 'hits': [
+            {'_id': '1', '_score': 2.0, '_source': {'title': query + ' 1'}},
+            {'_id': '7', '_score': 1.0, '_source': {'title': query + ' 7'}},
+        ]}})
+    return {'responses': responses}
+
+
+def test_elasticsearch_backend(tmpdir, mocker):
+    msearch = mocker.patch('elasticsearch.Elasticsearch.msearch', side_effect=fake_msearch)
+    config = make_es_config(tmpdir, ['a', 'b', 'broken', 'c'], msearchBatchSize='3')
+    results = [json.loads(line) for line in read_lines(runner.runSearch(config, 'test1'))]
+    assert msearch.call_count == 2
+    assert [r['query'] for r in results] == ['a', 'b', 'broken', 'c']
+    assert results[0] == {
+        'query': 'a',
+        'totalHits': 2,
+        'rows': [
+            {'docId': '1', 'title': 'a 1', 'score': 2.0},
+            {'docId': '7', 'title': 'a 7', 'score': 1.0},
+        ],
+    }
+    assert 'error' in results[2]
+
+    # Only the error is retried
+    msearch.reset_mock()
+    runner.runSearch(config, 'test1')
+    assert msearch.call_count == 1
+    assert len(msearch.call_args[1]['body']) == 2
+
+
+def test_elasticsearch_backend_missing_dump(tmpdir, mocker):
+    mocker.patch('elasticsearch.Elasticsearch.msearch', side_effect=fake_msearch)
+    config = make_es_config(tmpdir, ['a'])
+    with open(config.get('test1', 'queries'), 'a') as f:
+        f.write('b\n')
+    results = [json.loads(line) for line in read_lines(runner.runSearch(config, 'test1'))]
+    assert 'rows' in results[0]
+    assert results[1] == {'query': 'b', 'error': 'No query dump available'}
+
+
+@pytest.mark.parametrize('compression', runner.COMPRESSIONS)
+def test_open_results_round_trip(tmpdir, compression):
+    path = str(tmpdir.join('results'))
+    with runner.openResults(path, 'w', compression) as f:
+        f.write(u'{"query": "\u00e9"}\n{"query": "b"}\n')
+    with open(path, 'rb') as f:
+        assert runner.detectCompression(f.read(4)) == compression
+    assert read_lines(path) == [u'{"query": "\u00e9"}', '{"query": "b"}']
+
+
+def test_open_results_unknown_compression(tmpdir):
+    with pytest.raises(ValueError):
+        runner.openResults(str(tmpdir.join('results')), 'w', 'lzma')
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_run_search_compressed(tmpdir, compression):
+    config = make_config(tmpdir, ['a', 'b'], compression=compression)
+    results_path = runner.runSearch(config, 'test1')
+    with open(results_path, 'rb') as f:
+        assert runner.detectCompression(f.read(4)) == compression
+    assert [json.loads(line)['query'] for line in read_lines(results_path)] == ['a', 'b']
+    assert read_lines(os.path.join(os.path.dirname(results_path), 'queries')) == ['a', 'b']
+    ran_queries(tmpdir)
+
+    # Compressed cache entries are shared with uncompressed runs
+    config = make_config(tmpdir, ['a', 'b', 'c'])
+    results_path = runner.runSearch(config, 'test1')
+    assert ran_queries(tmpdir) == ['c']
+    with open(results_path, 'rb') as f:
+        assert f.read(1) == b'{'
+    assert [json.loads(line)['query'] for line in read_lines(results_path)] == ['a', 'b', 'c']
+
+
+def test_run_searches(tmpdir):
+    config = make_config(tmpdir, ['a', 'b', 'c'])
+    config.add_section('test2')
+    for key, value in config.items('test1'):
+        config.set('test2', key, value)
+    config.set('test2', 'name', 'pytest run 2')
+    config.add_section('test3')
+    config.set('test3', 'name', 'broken')
+    config.set('test3', 'queries', str(tmpdir.join('missing')))
+    config.set('test3', 'labHost', 'localhost')
+    config.set('test3', 'searchCommand', 'cat')
+
+    completed = {}
+    with pytest.raises(IOError):
+        for section, results_path in runner.runSearches(config, ['test1', 'test2', 'test3']):
+            completed[section] = read_lines(results_path)
+    assert sorted(completed.keys()) == ['test1', 'test2']
+    assert completed['test1'] == completed['test2']
+    # Both sections share a cache, so each query only ran once
+    assert sorted(ran_queries(tmpdir)) == ['a', 'b', 'c']
+
+
+@pytest.mark.parametrize('concurrency,expected', [(None, 3), (1, 1), (2, 2)])
+def test_run_searches_concurrency(mocker, concurrency, expected):
+    import threading
+    import time
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def fake_run_search(config, section, allow_reuse):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return section
+
+    mocker.patch.object(runner, 'runSearch', side_effect=fake_run_search)
+    sections = ['test1', 'test2', 'test3']
+    completed = [section for section, _ in runner.runSearches(None, sections, concurrency=concurrency)]
+    assert sorted(completed) == sections
+    assert running[1] == expected
+
+
+def test_result_cache_shared_between_processes(tmpdir):
+    import multiprocessing
+    cache_dir = str(tmpdir.join('cache'))
+    first = runner.ResultCache(cache_dir)
+    second = runner.ResultCache(cache_dir)
+    with first.appending():
+        first.add('a', b'{"query": "a"}')
+        # Another process appending to the same cache waits for the lock
+        proc = multiprocessing.get_context('spawn').Process(target=append_to_cache, args=(cache_dir, 'b'))
+        proc.start()
+        proc.join(1)
+        assert proc.is_alive()
+        first.add('c', b'{"query": "c"}')
+    proc.join()
+    assert proc.exitcode == 0
+    # Appending reloads the index, so entries of the other process keep their offsets
+    with second.appending():
+        assert len(second) == 3
+        second.add('d', b'{"query": "d"}')
+    cache = runner.ResultCache(cache_dir)
+    with cache.open() as f:
+        for query in 'abcd':
+            out = io.BytesIO()
+            cache.copyResult(f, query, out)
+            assert out.getvalue() == ('{"query": "%s"}\n' % (query)).encode('utf8')
+
+
+def append_to_cache(cache_dir, query):
+    cache = runner.ResultCache(cache_dir)
+    with cache.appending():
+        cache.add(query, ('{"query": "%s"}' % (query)).encode('utf8'))
+
+
+def cached_results(cache):
+    results = {}
+    with cache.reading() as f:
+        for query in sorted(cache._index):
+            out = io.BytesIO()
+            cache.copyResult(f, query, out)
+            results[query] = (out.getvalue(), cache.entry(query))
+    return results
+
+
+def test_result_cache_compact(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    cache = runner.ResultCache(cache_dir)
+    with cache.appending():
+        for i in range(3):
+            for query in 'abc':
+                cache.add(query, ('{"query": "%s", "run": %d}' % (query, i)).encode('utf8'))
+        cache.add('d', b'{"query": "d"}')
+    expected = cached_results(cache)
+    size = os.path.getsize(cache.results_path)
+    # Too few replaced entries to bother
+    assert not cache.compact(min_replaced=0.9)
+    assert cache.compact()
+    assert os.path.getsize(cache.results_path) < size / 2
+    with open(cache.index_path, 'rb') as f:
+        assert len(f.readlines()) == 4
+    # Entry numbers survive compaction, so checkpoints stay valid
+    assert cached_results(cache) == expected
+    assert cached_results(runner.ResultCache(cache_dir)) == expected
+    assert not cache.compact()
+    with cache.appending():
+        cache.add('e', b'{"query": "e"}')
+    cache = runner.ResultCache(cache_dir)
+    assert cache.entries == 11
+    assert cache.entry('e') == 10
+
+
+@pytest.mark.parametrize('swapped', [False, True])
+def test_result_cache_interrupted_compaction(tmpdir, mocker, swapped):
+    cache_dir = str(tmpdir.join('cache'))
+    cache = runner.ResultCache(cache_dir)
+    with cache.appending():
+        for query in 'abab':
+            cache.add(query, ('{"query": "%s"}' % (query)).encode('utf8'))
+    expected = cached_results(cache)
+    rename = os.rename
+
+    def interrupted_rename(src, dst):
+        if dst == cache.index_path or not swapped:
+            raise KeyboardInterrupt()
+        rename(src, dst)
+
+    mocker.patch.object(runner.os, 'rename', side_effect=interrupted_rename)
+    with pytest.raises(KeyboardInterrupt):
+        cache.compact()
+    mocker.stopall()
+    cache = runner.ResultCache(cache_dir)
+    assert cached_results(cache) == expected
+    assert sorted(os.listdir(cache_dir)) == ['index', 'lock', 'results']
+
+
+def test_result_cache_blocks(tmpdir, mocker):
+    mocker.patch.object(runner.ResultCache, 'BLOCK_SIZE', 1000)
+    cache_dir = str(tmpdir.join('cache'))
+    cache = runner.ResultCache(cache_dir, 'gzip')
+    lines = dict((str(i), ('{"query": "%d", "rows": [%s]}\n' % (i, ', '.join(['"Some title"'] * 5))).encode('utf8'))
+                 for i in range(100))
+    with cache.appending():
+        for query, line in lines.items():
+            cache.add(query, line)
+        # Lines are held back until their block fills up
+        assert 0 < len(cache._pending) < len(lines)
+    with open(cache.index_path, 'rb') as f:
+        blocks = set(line.split(b'\t')[0] for line in f)
+    assert 1 < len(blocks) < 20
+    # Compressing blocks of lines beats compressing them one at a time
+    per_line = sum(len(runner.compressBlock(line, 'gzip')) for line in lines.values())
+    assert os.path.getsize(cache.results_path) * 4 < per_line
+    cache = runner.ResultCache(cache_dir)
+    with cache.reading() as f:
+        for query in ['99', '0', '50', '51']:
+            out = io.BytesIO()
+            cache.copyResult(f, query, out)
+            assert out.getvalue() == lines[query]
+
+
+def test_result_cache_reads_line_per_block_index(tmpdir):
+    cache_dir = tmpdir.mkdir('cache')
+    lines = [b'{"query": "a", "run": 0}\n', b'{"query": "b"}\n', b'{"query": "a", "run": 1}\n']
+    with open(str(cache_dir.join('results')), 'wb') as results, open(str(cache_dir.join('index')), 'wb') as index:
+        for line in lines:
+            data = runner.compressBlock(line, 'gzip')
+            query = json.loads(line.decode('utf8'))['query']
+            index.write(('%d\t%d\t%s\n' % (results.tell(), len(data), json.dumps(query))).encode('utf8'))
+            results.write(data)
+    cache = runner.ResultCache(str(cache_dir), 'gzip')
+    assert cache.entries == 3
+    assert cache.entry('a') == 2
+    with cache.appending():
+        cache.add('c', b'{"query": "c"}')
+    assert cache.compact(min_replaced=0.2)
+    assert cached_results(runner.ResultCache(str(cache_dir))) == {
+        'a': (lines[2], 2),
+        'b': (lines[1], 1),
+        'c': (b'{"query": "c"}\n', 3),
+    }
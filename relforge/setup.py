@@ -2,6 +2,7 @@ from setuptools import setup
 
 requirements = [
     'elasticsearch>=5.0.0,<6.0.0',
+    'numpy',
     'pandas',
     'pyyaml',
 ]
@@ -25,6 +26,8 @@ setup(
     test_requires=test_requirements,
     extras_require={
         'test': requirements + test_requirements,
+        'zstd': ['zstandard'],
+        'mysqldb': ['pymysql'],
     },
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -15,15 +15,23 @@
 # http://www.gnu.org/copyleft/gpl.html
 
 import argparse
-import ConfigParser
+import collections
+import itertools
+import json
 import logging
 import os
 import sys
 import tempfile
 
+import pandas as pd
 import relforge.runner
 
-from relforge_engine_score.scores import init_scorer, load_results
+from relforge_engine_score.scorers import EngineScoreSet, init_scorer, load_results_file, score_diff
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
 
 
 LOG = logging.getLogger(__name__)
@@ -38,37 +46,133 @@ def genSettings(config):
     return get
 
 
-def score_for_config(config_path, verbose):
-    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
-
-    config = ConfigParser.ConfigParser()
-    with open(config_path) as f:
-        config.readfp(f)
-
-    relforge.runner.checkSettings(config, 'settings', ['query', 'workDir'])
-    relforge.runner.checkSettings(config, 'test1', [
-                                  'name', 'labHost', 'searchCommand'])
-    settings = genSettings(config)
-    scorer = init_scorer(settings)
+def sweep_sections(config):
+    """Add a section per point of the [sweep] grid to config
 
+    The grid option of [sweep] is a JSON object from search option names
+    to lists of values to try. Every combination is merged into a copy of
+    the search options of the base section, test1 by default. Returns a
+    list of (section, params) tuples, with params the dict of swept values
+    for that section.
+    """
+    base = config.get('sweep', 'base') if config.has_option('sweep', 'base') else 'test1'
+    try:
+        grid = json.loads(config.get('sweep', 'grid', raw=True), object_pairs_hook=collections.OrderedDict)
+    except ValueError:
+        raise ValueError('[sweep] grid must be a JSON object: %s' % (config.get('sweep', 'grid', raw=True)))
+    grid = [(key, values if isinstance(values, list) else [values]) for key, values in grid.items()]
+
+    base_options = json.loads(relforge.runner.readSearchOptions(config, base) or '{}')
+
+    sections = []
+    keys = [key for key, _ in grid]
+    for i, values in enumerate(itertools.product(*[values for _, values in grid]), 1):
+        params = dict(zip(keys, values))
+        options = dict(base_options)
+        options.update(params)
+        section = 'sweep%d' % (i)
+        config.add_section(section)
+        for key, value in config.items(base, raw=True):
+            if key not in config.defaults():
+                config.set(section, key, value)
+        description = ', '.join('%s=%s' % (key, json.dumps(params[key])) for key in keys)
+        config.set(section, 'name', '%s (%s)' % (config.get(base, 'name', raw=True), description))
+        config.set(section, 'config', json.dumps(options))
+        sections.append((section, params))
+    return sections
+
+
+def score_sections(config, scorer, sections, concurrency=None):
+    """Run the scorer's queries for each section and score the results
+
+    Up to concurrency searches run at once, and each result set is scored
+    with the already initialized scorer as soon as it is available.
+    Returns a dict from section to its score.
+    """
     # Write out a list of queries for the runner
     queries_temp = tempfile.mkstemp('_engine_score_queries')
     try:
-        with os.fdopen(queries_temp[0], 'w') as f:
+        with os.fdopen(queries_temp[0], 'wb') as f:
             f.write("\n".join(scorer.queries).encode('utf-8'))
-        config.set('test1', 'queries', queries_temp[1])
+        for section in sections:
+            config.set(section, 'queries', queries_temp[1])
         # Run all the queries
         print('Running queries')
-        results_dir = relforge.runner.runSearch(config, 'test1')
-        with open(results_dir) as f:
-            results = load_results(f)
-
-        print('Calculating engine score')
-        engine_score = scorer.engine_score(results)
+        engine_scores = {}
+        for section, results_dir in relforge.runner.runSearches(config, sections, concurrency=concurrency):
+            results = load_results_file(results_dir)
+            print('Calculating engine score for %s' % (config.get(section, 'name')))
+            engine_scores[section] = scorer.engine_score(results)
     finally:
         os.remove(queries_temp[1])
+    return engine_scores
+
 
-    engine_score.output()
+def _scores(engine_score):
+    if isinstance(engine_score, EngineScoreSet):
+        return engine_score.scores
+    return [engine_score]
+
+
+def sweep_table(sweep, engine_scores):
+    """One row per point of the sweep, with the swept values and all scores"""
+    rows = []
+    for section, params in sweep:
+        row = dict(params)
+        for score in _scores(engine_scores[section]):
+            row[score.name] = score.score
+            if score.interval is not None:
+                row[score.name + ' CI'] = '%0.3f - %0.3f' % score.interval
+        rows.append(row)
+    columns = [key for key in sweep[0][1]] if sweep else []
+    columns += [key for key in rows[0] if key not in columns] if rows else []
+    return pd.DataFrame(rows, columns=columns)
+
+
+def score_for_config(config_path, verbose):
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
+
+    config = configparser.ConfigParser()
+    with open(config_path) as f:
+        config.read_file(f)
+
+    relforge.runner.checkSettings(config, 'settings', ['query', 'workDir'])
+    # A second test section is optional, when present it is scored as
+    # well and compared against test1
+    sections = [s for s in ['test1', 'test2'] if s == 'test1' or config.has_section(s)]
+    for section in sections:
+        relforge.runner.checkSettings(config, section, [
+                                      'name', 'labHost', 'searchCommand'])
+    sweep = None
+    if config.has_section('sweep'):
+        # Sweep over a grid of search options based on test1 instead
+        sweep = sweep_sections(config)
+        sections = [section for section, _ in sweep]
+    settings = genSettings(config)
+    scorer = init_scorer(settings)
+    # Number of bootstrap resamples for confidence intervals, 0 disables them
+    num_samples = config.getint('settings', 'bootstrap') if config.has_option('settings', 'bootstrap') else 0
+    confidence = config.getfloat('settings', 'confidence') if config.has_option('settings', 'confidence') else 0.95
+    # Number of searches run at once, they all share the lab hosts
+    concurrency = config.getint('settings', 'concurrency') if config.has_option('settings', 'concurrency') else 4
+
+    engine_scores = score_sections(config, scorer, sections, concurrency)
+    if num_samples > 0:
+        for engine_score in engine_scores.values():
+            engine_score.bootstrap(num_samples, confidence)
+
+    if sweep is not None:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None):
+            print(sweep_table(sweep, engine_scores).to_string(index=False))
+        return
+
+    for section in sections:
+        if len(sections) > 1:
+            print('%s:' % (config.get(section, 'name')))
+        engine_scores[section].output()
+    if len(sections) > 1:
+        print('Paired difference, %s - %s:' % (config.get('test2', 'name'), config.get('test1', 'name')))
+        score_diff(engine_scores['test1'], engine_scores['test2'], max(num_samples, 1000), confidence).output()
 
 
 def parse_arguments(argv):
@@ -14,15 +14,19 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 # http://www.gnu.org/copyleft/gpl.html
 
-from collections import Counter, defaultdict
-import functools
-import itertools
-import json
+import bisect
+from collections import defaultdict
 import logging
-import math
-import operator
+import multiprocessing
+import os
 import random
+import shutil
+import tempfile
 
+import numpy as np
+import pandas as pd
+
+from relforge.columnar import ColumnarResults, StringColumn, iter_rows
 from relforge.query import CachedQuery
 
 try:
@@ -44,18 +48,22 @@ def init_scorer(settings):
     }
 
     query = CachedQuery(settings)
-    query_data = query.fetch()
+    # The memory mapped columns of the cached query. Scorers that can
+    # read them directly do, the others iterate over the rows.
+    columns = query.fetch_columns()
     scoring_configs = query.scoring_config
     if type(scoring_configs) != list:
         scoring_configs = [scoring_configs]
 
     scorers = []
-    iters = itertools.tee(query_data, len(scoring_configs))
-    for config, query_data_iter in zip(scoring_configs, iters):
+    for config in scoring_configs:
         algo = config['algorithm']
         print('Initializing engine scorer: %s' % (algo))
         scoring_class = scoring_algos[algo]
-        scorer = scoring_class(query_data_iter, config['options'])
+        if hasattr(scoring_class, 'from_columns'):
+            scorer = scoring_class.from_columns(columns, config['options'])
+        else:
+            scorer = scoring_class(iter_rows(columns), config['options'])
         scorer.report()
         scorers.append(scorer)
 
@@ -67,29 +75,114 @@ def init_scorer(settings):
 
 def load_results(json_lines):
     # Load the results
-    results = {}
-    for line in json_lines:
-        decoded = json.loads(line)
-        hits = []
-        if 'error' in decoded:
-            LOG.warning('Error in result: %s', line)
-        else:
-            for hit in decoded['rows']:
-                try:
-                    # Cirrus
-                    docId = str(hit['docId'])
-                except KeyError:
-                    # Wikidata
-                    docId = str(hit['pageId'])
-                hits.append({
-                    'docId': docId,
-                    'title': hit['title'],
-                })
-        if decoded['query'] in results:
-            raise Exception('Duplicate result sets for {}'.format(decoded['query']))
-        results[decoded['query']] = hits
-    LOG.debug('Loaded %d results', len(results))
-    return results
+    return ColumnarResults.from_json_lines(json_lines).to_results()
+
+
+def load_results_file(path):
+    # Load the results from a runSearch results file, reusing the columnar
+    # form saved by earlier loads of the same file.
+    return ColumnarResults.for_results_file(path).to_results()
+
+
+def _get_indexer(index, values):
+    """Position of each value in a pandas Index, or -1 if it is missing"""
+    if isinstance(values, pd.Categorical):
+        # Missing values have code -1, which mustn't wrap around to the
+        # last category
+        indexer = index.get_indexer(values.categories)
+        return np.where(values.codes >= 0, indexer[values.codes], -1)
+    return index.get_indexer(values)
+
+
+class ResultIndex(object):
+    """Shared per query index of a results dict
+
+    The hits of all queries are flattened once, in query and rank order,
+    with hit_rows and hit_ranks giving the query row and 0-indexed rank of
+    each hit. Doc ids and titles are interned to integer codes on first
+    use, and lookups keyed by (query, title) or (query, docId) are then
+    vectorized over all hits. MultiScorer builds one index and hands it
+    to every scorer, so the results are only traversed once.
+    """
+    def __init__(self, results):
+        self.results = results
+        self.queries = list(results)
+        hit_lists = [results[query] for query in self.queries]
+        num_hits = np.array([len(hits) for hits in hit_lists], dtype=np.int64)
+        self.doc_ids = [hit['docId'] for hits in hit_lists for hit in hits]
+        self.titles = [hit['title'] for hits in hit_lists for hit in hits]
+        self.hit_rows = np.repeat(np.arange(len(self.queries)), num_hits)
+        self.hit_ranks = np.arange(len(self.doc_ids)) - np.repeat(np.cumsum(num_hits) - num_hits, num_hits)
+        self.query_index = pd.Index(self.queries)
+        self._codes = {}
+        self._doc_ranks = None
+
+    @classmethod
+    def of(cls, results):
+        """Index results unless they already are an index"""
+        if isinstance(results, cls):
+            return results
+        return cls(results)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def codes(self, key):
+        """Integer code of each hit's docId or title, and the values coded"""
+        if key not in self._codes:
+            codes, uniques = pd.factorize(np.array(self.doc_ids if key == 'docId' else self.titles, dtype=object))
+            self._codes[key] = (codes, pd.Index(uniques))
+        return self._codes[key]
+
+    def hit_values(self, queries, keys, values, key='title', default=0):
+        """Value of each hit, looked up by (query, hit[key])
+
+        queries, keys and values are parallel sequences, each (query, key)
+        pair should only appear once. queries and keys can be given as
+        pandas Categoricals to only look up each distinct value once. Hits
+        without a value get default.
+        """
+        codes, uniques = self.codes(key)
+        num_codes = max(len(uniques), 1)
+        rows = _get_indexer(self.query_index, queries)
+        key_codes = _get_indexer(uniques, keys)
+        known = (rows >= 0) & (key_codes >= 0)
+        packed = rows[known] * num_codes + key_codes[known]
+        order = np.argsort(packed)
+        packed = packed[order]
+        values = np.asarray(values, dtype=np.float64)[known][order]
+
+        hit_values = np.full(len(codes), default, dtype=np.float64)
+        if len(packed):
+            # factorize codes missing (None) values as -1, which would
+            # pack into the last code of the previous row
+            hits = np.flatnonzero(codes >= 0)
+            hit_packed = self.hit_rows[hits] * num_codes + codes[hits]
+            found = np.minimum(np.searchsorted(packed, hit_packed), len(packed) - 1)
+            matched = packed[found] == hit_packed
+            hit_values[hits[matched]] = values[found[matched]]
+        return hit_values
+
+    def top_k(self, values, k, default=0):
+        """Arrange per hit values into a (queries x k) matrix of the top k hits"""
+        keep = self.hit_ranks < k
+        matrix = np.full((len(self.queries), k), default, dtype=np.asarray(values).dtype)
+        matrix[self.hit_rows[keep], self.hit_ranks[keep]] = np.asarray(values)[keep]
+        return matrix
+
+    @property
+    def doc_ranks(self):
+        """Dict from query to a dict of docId to its 1-indexed rank"""
+        if self._doc_ranks is None:
+            self._doc_ranks = {}
+            for query, hits in self.results.items():
+                ranks = {}
+                # Enumerate from 1, the first position is rank 1. Only
+                # the first occurrence of a docId counts.
+                for i, hit in enumerate(hits, 1):
+                    ranks.setdefault(hit['docId'], i)
+                self._doc_ranks[query] = ranks
+        return self._doc_ranks
 
 
 class MultiScorer(object):
@@ -105,6 +198,8 @@ class MultiScorer(object):
             scorer.report()
 
     def engine_score(self, results):
+        # Index the results once, shared by all the scorers
+        results = ResultIndex.of(results)
         scores = []
         for scorer in self.scorers:
             score = scorer.engine_score(results)
@@ -116,22 +211,96 @@ class MultiScorer(object):
 
 
 class MRR_AC(object):
-    """Mean Reciprocal Rank for Auto Complete"""
+    """Mean Reciprocal Rank for Auto Complete
+
+    Clicks are counted once per distinct (query, page id). Scoring walks
+    the queries in sorted order, which visits them as the leaves of a
+    prefix trie without storing one: each prefix is visited once with the
+    click weights of every query below it, merged up from its children.
+    """
     def __init__(self, rows, options):
-        self._queries = defaultdict(list)
+        # Maps each query to the number of clicks per page id
+        self._clicks = {}
+        # Interned page ids, shared between queries
+        self._page_ids = {}
+        self._num_clicks = 0
         for row in rows:
             query, page_id = row
-            self._queries[query].append(int(page_id))
-        self.queries = set(q[:i + 1] for q in self._queries.keys() for i in range(len(q)))
+            # result lists hold elasticsearch docId's which are always a
+            # stringified page id
+            self._add_click(query, str(int(page_id)))
+
+    def _add_click(self, query, page_id):
+        if not query:
+            LOG.debug("skipping click with empty query")
+            return
+        page_id = self._page_ids.setdefault(page_id, page_id)
+        try:
+            counts = self._clicks[query]
+        except KeyError:
+            counts = self._clicks[query] = {}
+        counts[page_id] = counts.get(page_id, 0) + 1
+        self._num_clicks += 1
+
+    def _walk(self):
+        """Yield (prefix, weights) for every prefix of the clicked queries
+
+        weights maps page ids to the summed 1 / len(query) weight of the
+        clicks on queries starting with prefix. Each entry of the stack is
+        a trie node, as (depth, weights), on the path to the current query.
+        Popped nodes are merged into their parent, the smaller dict into
+        the larger, so each weight is copied O(log n) times.
+        """
+        stack = [(0, {})]
+        prev = ''
+        for query in sorted(self._clicks):
+            lcp = len(os.path.commonprefix([prev, query]))
+            for item in self._pop_to(stack, lcp, prev):
+                yield item
+            weight = 1. / len(query)
+            stack.append((len(query), dict((page_id, count * weight)
+                                           for page_id, count in self._clicks[query].items())))
+            prev = query
+        for item in self._pop_to(stack, 0, prev):
+            yield item
+
+    @staticmethod
+    def _pop_to(stack, depth, query):
+        while stack[-1][0] > depth:
+            node_depth, weights = stack.pop()
+            parent_depth = max(stack[-1][0], depth)
+            # The prefixes between the parent and this node have no other
+            # queries below them.
+            for i in range(parent_depth + 1, node_depth + 1):
+                yield query[:i], weights
+            if stack[-1][0] < depth:
+                # Branching point below the parent
+                stack.append((depth, weights))
+                continue
+            parent_depth, parent = stack[-1]
+            if len(parent) < len(weights):
+                parent, weights = weights, parent
+                stack[-1] = (parent_depth, parent)
+            for page_id, weight in weights.items():
+                parent[page_id] = parent.get(page_id, 0.) + weight
+
+    @property
+    def queries(self):
+        """Every prefix of the clicked queries"""
+        prev = ''
+        for query in sorted(self._clicks):
+            lcp = len(os.path.commonprefix([prev, query]))
+            for i in range(lcp + 1, len(query) + 1):
+                yield query[:i]
+            prev = query
 
     def name(self):
         return "MRR_AC"
 
     def report(self):
-        num_clicks = sum(len(page_ids) for page_ids in self._queries.values())
-        num_prefixes = len(self.queries)
+        num_prefixes = sum(1 for _ in self.queries)
         print("Loaded MRR with %d clicks and %d unique prefixes" %
-              (num_clicks, num_prefixes))
+              (self._num_clicks, num_prefixes))
 
     @staticmethod
     def score_query(results, query, page_id, allow_missing=False):
@@ -154,33 +323,273 @@ class MRR_AC(object):
                 yield 1. / j
 
     def engine_score(self, results):
-        # Enumerate from 1 as MRR is 1 indexed, giving first position the score 1/1.
-        results = {q: {hit['docId']: i for i, hit in enumerate(hits, 1)}
-                   for q, hits in results.items()}
-        score = 0
-        N = 0
-        for query, page_ids in self._queries.items():
-            for page_id in page_ids:
-                # Not 100% what is right but this is mean per query
-                # instead of per prefix.
-                query_score = list(self.score_query(results, query, page_id))
-                score += sum(query_score) / len(query_score)
-                N += 1
-        return EngineScore(self.name(), score / N)
+        # Not 100% what is right but this is mean per query instead of per
+        # prefix. Each click is weighted by 1 / len(query), summing
+        # weight / rank over all prefixes gives the sum of the per query
+        # means.
+        doc_ranks = ResultIndex.of(results).doc_ranks
+        score = 0.
+        for prefix, weights in self._walk():
+            try:
+                ranks = doc_ranks[prefix]
+            except KeyError:
+                raise Exception('Missing results for prefix {}'.format(prefix))
+            for page_id, rank in ranks.items():
+                if page_id in weights:
+                    score += weights[page_id] / rank
+        return EngineScore(self.name(), score / self._num_clicks)
+
+
+class MPCBuilder(object):
+    """Streaming builder of Most Popular Completion models
+
+    Queries and page ids are interned to integers, and votes are counted
+    per (query, page) in a sorted table of packed int64 keys. Prefixes are
+    never held as strings: build() walks the queries in sorted order,
+    where each prefix is first met at the first query starting with it,
+    and numbers the prefixes in that order. The votes of every prefix go
+    through a second table that is spilled to a temporary file when it
+    grows past memory_budget bytes, and is merged back one range of
+    prefixes at a time, keeping only the top_k pages of each prefix.
+    """
+    BUFFER_SIZE = 1000000
+    # Bytes per table entry, an int64 key and an int64 count
+    ENTRY_SIZE = 16
+
+    def __init__(self, top_k=None, memory_budget=1 << 30):
+        self.top_k = top_k
+        self.max_entries = max(1, memory_budget // self.ENTRY_SIZE)
+        self._query_ids = {}
+        self._page_ids = {}
+        self._query_buffer = []
+        self._query_buffered = 0
+        self._query_keys = np.zeros(0, dtype=np.int64)
+        self._query_counts = np.zeros(0, dtype=np.int64)
+        self._buffer = []
+        self._buffered = 0
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._spill_dir = None
+        self._runs = []
+
+    def add(self, query, page_ids):
+        """Vote for page_ids on every prefix of query"""
+        if not query or not page_ids:
+            return
+        query_id = self._query_ids.setdefault(query, len(self._query_ids))
+        page_ids = np.array([self._page_ids.setdefault(page_id, len(self._page_ids))
+                             for page_id in page_ids], dtype=np.int64)
+        self._query_buffer.append((query_id << 32) | page_ids)
+        self._query_buffered += len(page_ids)
+        if self._query_buffered >= self.BUFFER_SIZE:
+            self._flush_queries()
+
+    @staticmethod
+    def _aggregate(keys, counts):
+        unique, inverse = np.unique(keys, return_inverse=True)
+        return unique, np.bincount(inverse, weights=counts, minlength=len(unique)).astype(np.int64)
+
+    def _flush_queries(self):
+        if not self._query_buffer:
+            return
+        keys = np.concatenate(self._query_buffer + [self._query_keys])
+        counts = np.concatenate([np.ones(self._query_buffered, dtype=np.int64), self._query_counts])
+        self._query_buffer = []
+        self._query_buffered = 0
+        self._query_keys, self._query_counts = self._aggregate(keys, counts)
+
+    def _add_prefix_votes(self, keys, counts):
+        self._buffer.append((keys, counts))
+        self._buffered += len(keys)
+        if self._buffered >= self.BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        keys = np.concatenate([keys for keys, _ in self._buffer] + [self._keys])
+        counts = np.concatenate([counts for _, counts in self._buffer] + [self._counts])
+        self._buffer = []
+        self._buffered = 0
+        self._keys, self._counts = self._aggregate(keys, counts)
+        if len(self._keys) > self.max_entries:
+            self._spill()
+
+    def _spill(self):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='mpc_')
+        path = os.path.join(self._spill_dir, 'run%d' % (len(self._runs)))
+        LOG.debug("Spilling %d mpc votes to %s", len(self._keys), path)
+        np.save(path + '.keys.npy', self._keys)
+        np.save(path + '.counts.npy', self._counts)
+        self._runs.append(path)
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+
+    def _ranges(self, num_prefixes):
+        """Yield aggregated (keys, counts) for consecutive ranges of prefixes"""
+        if not self._runs:
+            yield self._keys, self._counts
+            return
+        runs = [(self._keys, self._counts)] + [
+            (np.load(path + '.keys.npy', mmap_mode='r'), np.load(path + '.counts.npy', mmap_mode='r'))
+            for path in self._runs]
+        # Each run holds up to max_entries, so splitting the prefixes into
+        # one range per run keeps about that many entries in memory.
+        bounds = np.linspace(0, num_prefixes, len(runs) + 1).astype(np.int64) << 32
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            keys = []
+            counts = []
+            for run_keys, run_counts in runs:
+                start, end = np.searchsorted(run_keys, [lo, hi])
+                keys.append(run_keys[start:end])
+                counts.append(run_counts[start:end])
+            yield self._aggregate(np.concatenate(keys), np.concatenate(counts))
+
+    def _vote_prefixes(self):
+        """Number the prefixes and vote on them, returning the sorted queries
+
+        Also returns, per sorted query, the length of the prefix shared
+        with the previous query and the id of its first prefix that isn't.
+        """
+        self._flush_queries()
+        queries = [None] * len(self._query_ids)
+        for query, i in self._query_ids.items():
+            queries[i] = query
+        self._query_ids = {}
+        order = sorted(range(len(queries)), key=queries.__getitem__)
+        query_offsets = np.searchsorted(self._query_keys, np.arange(len(queries) + 1, dtype=np.int64) << 32)
+        pages = self._query_keys & 0xffffffff
+        counts = self._query_counts
+        lcps = np.zeros(len(queries), dtype=np.int64)
+        bases = np.zeros(len(queries), dtype=np.int64)
+        # Prefix ids of the current query
+        path = np.zeros(max(len(q) for q in queries) if queries else 0, dtype=np.int64)
+        num_prefixes = 0
+        prev = ''
+        for j, query_id in enumerate(order):
+            query = queries[query_id]
+            lcp = len(os.path.commonprefix([prev, query]))
+            lcps[j] = lcp
+            bases[j] = num_prefixes
+            path[lcp:len(query)] = np.arange(num_prefixes, num_prefixes + len(query) - lcp)
+            num_prefixes += len(query) - lcp
+            start, end = query_offsets[query_id], query_offsets[query_id + 1]
+            keys = ((path[:len(query)] << 32)[:, None] | pages[None, start:end]).ravel()
+            self._add_prefix_votes(keys, np.tile(counts[start:end], len(query)))
+            prev = query
+        self._query_keys = self._query_counts = None
+        self._flush()
+        return [queries[i] for i in order], lcps, bases, num_prefixes
+
+    def build(self):
+        """Returns the MPCModel of the votes"""
+        queries, lcps, bases, num_prefixes = self._vote_prefixes()
+        page_ids = [None] * len(self._page_ids)
+        for page_id, i in self._page_ids.items():
+            page_ids[i] = page_id
+
+        prefixes = []
+        pages = []
+        ranks = []
+        try:
+            for keys, counts in self._ranges(num_prefixes):
+                prefix = keys >> 32
+                page = keys & 0xffffffff
+                # Most votes first within each prefix. Pages with equal
+                # votes are ordered by when they were first seen.
+                order = np.lexsort((page, -counts, prefix))
+                prefix = prefix[order]
+                page = page[order]
+                starts = np.flatnonzero(np.r_[True, prefix[1:] != prefix[:-1]])
+                rank = np.arange(1, len(prefix) + 1) - np.repeat(starts, np.diff(np.r_[starts, len(prefix)]))
+                if self.top_k is not None:
+                    keep = rank <= self.top_k
+                    prefix, page, rank = prefix[keep], page[keep], rank[keep]
+                # Order pages by id within each prefix, for lookups
+                order = np.lexsort((page, prefix))
+                prefixes.append(prefix[order])
+                pages.append(page[order])
+                ranks.append(rank[order].astype(np.int32))
+        finally:
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir)
+                self._spill_dir = None
+                self._runs = []
+        prefixes = np.concatenate(prefixes)
+        offsets = np.zeros(num_prefixes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(prefixes, minlength=num_prefixes), out=offsets[1:])
+        return MPCModel(queries, lcps, bases, offsets, np.concatenate(pages), np.concatenate(ranks), page_ids)
+
+
+class MPCModel(object):
+    """Ranked pages per prefix of a Most Popular Completion model
+
+    Prefixes are identified through the sorted queries. The id of a
+    prefix is found from the first query at or after it in sorted order,
+    which starts with it, as bases[j] + len(prefix) - lcps[j] - 1. The
+    ranked pages of prefix i are pages[offsets[i]:offsets[i + 1]], ordered
+    by page so they can be searched, with their ranks alongside.
+    """
+    def __init__(self, queries, lcps, bases, offsets, pages, ranks, page_ids):
+        self.queries = queries
+        self.lcps = lcps
+        self.bases = bases
+        self.offsets = offsets
+        self.pages = pages
+        self.ranks = ranks
+        self.page_ids = page_ids
+        self._page_index = dict((page_id, i) for i, page_id in enumerate(page_ids))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for query, lcp in zip(self.queries, self.lcps.tolist()):
+            for i in range(lcp + 1, len(query) + 1):
+                yield query[:i]
+
+    def __contains__(self, prefix):
+        return self.prefix_id(prefix) is not None
+
+    def __getitem__(self, prefix):
+        """Dict from page id to 1-indexed rank of the pages of prefix"""
+        i = self.prefix_id(prefix)
+        if i is None:
+            raise KeyError(prefix)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return dict((self.page_ids[page], rank)
+                    for page, rank in zip(self.pages[lo:hi].tolist(), self.ranks[lo:hi].tolist()))
+
+    def prefix_id(self, prefix):
+        j = bisect.bisect_left(self.queries, prefix)
+        if not prefix or j == len(self.queries) or not self.queries[j].startswith(prefix):
+            return None
+        return int(self.bases[j]) + len(prefix) - int(self.lcps[j]) - 1
+
+    def rank(self, prefix, page_id):
+        """1-indexed rank of page_id for prefix, or None if it isn't ranked
+
+        Raises KeyError if the model has no such prefix.
+        """
+        i = self.prefix_id(prefix)
+        if i is None:
+            raise KeyError(prefix)
+        page = self._page_index.get(page_id)
+        if page is None:
+            return None
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        j = lo + np.searchsorted(self.pages[lo:hi], page)
+        if j < hi and self.pages[j] == page:
+            return int(self.ranks[j])
+        return None
 
 
-def calc_mpc(queries):
-    votes = defaultdict(Counter)
+def calc_mpc(queries, top_k=None, memory_budget=1 << 30):
+    builder = MPCBuilder(top_k, memory_budget)
     for query, page_ids in queries.items():
-        for i in range(len(query)):
-            prefix = query[:i + 1]
-            votes[prefix].update(page_ids)
-    results = {}
-    for prefix, counts in votes.items():
-        # TODO: Elements with equal counts are ordered arbitrarily. Not sure
-        # what is appropriate to do here.
-        results[prefix] = {page_id: i for i, (page_id, count) in enumerate(counts.most_common(), 1)}
-    return results
+        builder.add(query, page_ids)
+    return builder.build()
 
 
 class MPC(object):
@@ -206,7 +615,10 @@ class MPC(object):
                 self.test_set[query].append(str(page_id))
             else:
                 self.train_set[query].append(str(page_id))
-        self.model = calc_mpc(self.train_set)
+        top_k = options.get('top_k')
+        # Memory budget for the vote table, in MB, before spilling to disk
+        memory_budget = int(options.get('memory_budget', 1024)) << 20
+        self.model = calc_mpc(self.train_set, None if top_k is None else int(top_k), memory_budget)
         # We don't require any external search requests
         self.queries = []
 
@@ -233,13 +645,36 @@ class MPC(object):
                 # instead of per prefix. We have to allow missing for
                 # the test/train split where some prefixes only exist
                 # on one side.
-                query_score = list(MRR_AC.score_query(
-                    self.model, query, page_id, allow_missing=True))
-                score += sum(query_score) / len(query_score)
+                query_score = 0.
+                for i in range(len(query)):
+                    try:
+                        rank = self.model.rank(query[:i + 1], page_id)
+                    except KeyError:
+                        continue
+                    if rank is not None:
+                        query_score += 1. / rank
+                score += query_score / len(query)
                 N += 1
         return EngineScore(self.name(), score / N)
 
 
+def _discounts(k):
+    # Note this is i+2, rather than i+1, because the i+1 algo starts
+    # is 1 indexed, and we are 0 indexed. log base 2 of 1 is 0 and
+    # we would have a div by zero problem otherwise
+    return 1. / np.log2(np.arange(k) + 2)
+
+
+def _dcg_at(grades, ks):
+    """DCG of each row of a (queries x k_max) grade matrix, for each k in ks
+
+    Rows shorter than k are padded with grade 0, which adds no gain, so a
+    single cumulative sum gives the DCG at every cutoff.
+    """
+    cumulative = np.cumsum((np.exp2(grades) - 1) * _discounts(grades.shape[1]), axis=1)
+    return {k: cumulative[:, k - 1] for k in ks}
+
+
 # Discounted Cumulative Gain
 class DCG(object):
     def __init__(self, rows, options):
@@ -251,32 +686,42 @@ class DCG(object):
         self._relevance = defaultdict(dict)
         for query, title, score in rows:
             self._relevance[query][title] = score
+        self._judgment_lists = None
 
     def name(self):
         return "DCG@%d" % (self.k)
 
-    def _relevance_score(self, query, hit):
-        if query not in self._relevance:
-            return 0
-        title = hit['title']
-        if title not in self._relevance[query]:
-            return 0
-        return self._relevance[query][title]
+    def _judgments(self):
+        """Relevance judgments as parallel arrays of queries, titles and grades"""
+        if self._judgment_lists is None:
+            queries = []
+            titles = []
+            grades = []
+            for query, judged in self._relevance.items():
+                queries.extend([query] * len(judged))
+                titles.extend(judged.keys())
+                grades.extend(judged.values())
+            self._judgment_lists = (pd.Categorical(queries), pd.Categorical(titles),
+                                    np.array(grades, dtype=np.float64))
+        return self._judgment_lists
+
+    def gain_matrix(self, results, k):
+        """Relevance grades of the top k hits of each query in results
+
+        Returns the list of queries and a (queries x k) matrix of grades,
+        missing hits and unjudged titles have grade 0.
+        """
+        index = ResultIndex.of(results)
+        grades = index.hit_values(*self._judgments(), key='title')
+        return index.queries, index.top_k(grades, k)
 
     # Returns the average DCG of the results
     def engine_score(self, results):
-        self.dcgs = {}
-        for query in results:
-            hits = results[query]
-            dcg = 0
-            for i in xrange(0, min(self.k, len(hits))):
-                top = math.pow(2, self._relevance_score(query, hits[i])) - 1
-                # Note this is i+2, rather than i+1, because the i+1 algo starts
-                # is 1 indexed, and we are 0 indexed. log base 2 of 1 is 0 and
-                # we would have a div by zero problem otherwise
-                dcg += top / math.log(i+2, 2)
-            self.dcgs[query] = dcg
-        return EngineScore(self.name(), sum(self.dcgs.values()) / len(results))
+        queries, grades = self.gain_matrix(results, self.k)
+        dcgs = _dcg_at(grades, [self.k])[self.k]
+        self.dcgs = dict(zip(queries, dcgs.tolist()))
+        return EngineScore(self.name(), float(dcgs.sum()) / len(results),
+                           per_query=pd.Series(dcgs, index=queries))
 
 
 # Idealized Discounted Cumulative Gain. Computes DCG against the ideal
@@ -285,34 +730,54 @@ class DCG(object):
 class IDCG(DCG):
     def __init__(self, rows, options):
         super(IDCG, self).__init__(rows, options)
+        # The ideal ordering only depends on the relevance judgments, so
+        # the ideal DCG of every query is computed once for all k.
+        ks = options.get('k', 20)
+        if not isinstance(ks, list):
+            ks = [int(ks)]
+        queries, grades = self.ideal_matrix(max(ks))
+        self.ideal_row = {query: i for i, query in enumerate(queries)}
+        self.idcgs = _dcg_at(grades, ks)
 
     def name(self):
         return "IDCG@%d" % (self.k)
 
+    def ideal_matrix(self, k):
+        """Grades of the ideal top k hits of each judged query
+
+        Returns the list of queries and a (queries x k) matrix holding
+        each query's grades sorted from best to worst.
+        """
+        queries = list(self._relevance)
+        grades = np.zeros((len(queries), k))
+        for i, query in enumerate(queries):
+            ideal = sorted(self._relevance[query].values(), reverse=True)[:k]
+            grades[i, :len(ideal)] = ideal
+        return queries, grades
+
+    def idcg_at(self, k):
+        """Ideal DCG at k of each judged query, ordered as ideal_row"""
+        if k not in self.idcgs:
+            _, grades = self.ideal_matrix(k)
+            self.idcgs[k] = _dcg_at(grades, [k])[k]
+        return self.idcgs[k]
+
     # The results argument is unused here, as this is the ideal and unrelated
     # to the actual search results returned
     def engine_score(self, results):
-        ideal_results = {}
-        for query in self._relevance:
-            # Build up something that looks like the hits search returns
-            ideal_hits = []
-            for title in self._relevance[query]:
-                ideal_hits.append({'title': title})
-
-            # Sort them into the ideal order and slice to match
-            sorter = functools.partial(self._relevance_score, query)
-            ideal_results[query] = sorted(ideal_hits, key=sorter, reverse=True)
-
-        # Run DCG against the ideal ordered results
-        return EngineScore(self.name(), super(IDCG, self).engine_score(ideal_results))
+        idcgs = self.idcg_at(self.k)
+        self.dcgs = dict(zip(self.ideal_row, idcgs.tolist()))
+        return EngineScore(self.name(), float(idcgs.sum()) / len(idcgs),
+                           per_query=pd.Series(idcgs, index=list(self.ideal_row)))
 
 
 # Normalized Discounted Cumulative Gain
 class nDCG(object):
     def __init__(self, rows, options):
-        # list() makes a copy, so each gets their own unique list
-        self.dcg = DCG(list(rows), options)
-        self.idcg = IDCG(list(rows), options)
+        # rows may be a one-shot iterator, both need the same judgments
+        rows = list(rows)
+        self.dcg = DCG(rows, options)
+        self.idcg = IDCG(rows, options)
         self.queries = self.dcg._relevance.keys()
         self.k = options.get('k', 20)
         if type(self.k) != list:
@@ -329,38 +794,31 @@ class nDCG(object):
         print("Loaded nDCG with %d queries and %d scored results" %
               (len(self.queries), num_results))
 
-    def _query_score(self, query):
-        try:
-            dcg = self.dcg.dcgs[query]
-            idcg = self.idcg.dcgs[query]
-            return dcg / idcg if idcg > 0 else 0
-        except KeyError:
+    def engine_score(self, results):
+        k_max = max(self.k)
+        queries, grades = self.dcg.gain_matrix(results, k_max)
+        dcgs = _dcg_at(grades, self.k)
+
+        # Row of each result query in the ideal DCGs, or -1 if it has
+        # no relevance judgments.
+        ideal_row = self.idcg.ideal_row
+        rows = np.array([ideal_row.get(query, -1) for query in queries], dtype=np.int64)
+        found = rows >= 0
+        errors = len(queries) - int(found.sum())
+        if errors > 0:
             # @todo this shouldn't be necessary, but there is some sort
             # of utf8 round tripping problem that breaks a few queries
-            LOG.debug("failed to find query (%s) in scores", query)
-            return None
+            LOG.debug("failed to find %d queries in scores", errors)
+            print("Expected %d queries, but %d were missing" % (len(queries), errors))
 
-    def engine_score(self, results):
+        found_queries = [query for query, is_found in zip(queries, found) if is_found]
         scores = []
         for k in self.k:
-            self.dcg.k = k
-            self.dcg.engine_score(results)
-            self.idcg.k = k
-            self.idcg.engine_score(results)
-
-            ndcgs = []
-            errors = 0
-            for query in self.dcg.dcgs:
-                ndcg = self._query_score(query)
-                if ndcg is None:
-                    errors += 1
-                else:
-                    ndcgs.append(ndcg)
-
-            if errors > 0:
-                print("Expected %d queries, but %d were missing" % (len(self.dcg.dcgs), errors))
-
-            scores.append(EngineScore(self.name(k), sum(ndcgs) / len(ndcgs)))
+            dcg = dcgs[k][found]
+            idcg = self.idcg.idcg_at(k)[rows[found]]
+            ndcgs = np.divide(dcg, idcg, out=np.zeros_like(dcg), where=idcg > 0)
+            scores.append(EngineScore(self.name(k), float(ndcgs.sum()) / len(ndcgs),
+                                      per_query=pd.Series(ndcgs, index=found_queries)))
         return EngineScoreSet(scores)
 
 
@@ -398,42 +856,116 @@ class ERR(DCG):
             k = self.k[0]
         return "ERR@%d" % (k)
 
-    def _probability_of_relevance(self, query, hit):
-        # Map from hit to relevance grade
-        score = self._relevance_score(query, hit)
+    def _err_at(self, grades, ks):
         # Map from relevance grade to probability of relevance
         # On the example scale of {0, 1, 2, 3} this gives
         # probabilities of {0, 12.5, 37.5, 87.5}
-        return (pow(2, score) - 1) / self.max_rel
-
-    def _query_score(self, k, query, hits):
-        p = 1
-        err = 0
-        for i in xrange(0, min(k, len(hits))):
-            # The r value is 1-indexed
-            r = i + 1
-            R = self._probability_of_relevance(query, hits[i])
-            err = err + p * (R / r)
-            p = p * (1 - R)
-        return err
+        R = (np.exp2(grades) - 1) / self.max_rel
+        # Probability the user was not satisfied by any of the hits
+        # above each rank
+        p = np.ones_like(R)
+        np.cumprod(1 - R[:, :-1], axis=1, out=p[:, 1:])
+        # The r value is 1-indexed
+        r = np.arange(1, grades.shape[1] + 1)
+        cumulative = np.cumsum(p * R / r, axis=1)
+        return {k: cumulative[:, k - 1] for k in ks}
 
     def engine_score(self, results):
+        queries, grades = self.gain_matrix(results, max(self.k))
+        errs = self._err_at(grades, self.k)
         scores = []
         for k in self.k:
-            total_err = sum([self._query_score(k, q, results[q]) for q in results])
-            scores.append(EngineScore(self.name(k), total_err / len(results)))
+            scores.append(EngineScore(self.name(k), float(errs[k].sum()) / len(results),
+                                      per_query=pd.Series(errs[k], index=queries)))
         return EngineScoreSet(scores)
 
 
+def _csr(groups, values, num_groups):
+    """Sort values by group and return (offsets, values) with group i at offsets[i]:offsets[i + 1]"""
+    order = np.lexsort((values, groups))
+    offsets = np.zeros(num_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=num_groups), out=offsets[1:])
+    return offsets, values[order]
+
+
+def _paul_score_sessions(factors, hit_codes, sessions):
+    """Sum the PaulScore of sessions for every factor in one pass
+
+    hit_codes holds the click code of each hit per query, or -1 for hits
+    that were never clicked. sessions is a tuple of (click_offsets,
+    clicks, query_offsets, queries) arrays. Returns a (sessions x factors)
+    array of session scores, and an array counting the positions clicked
+    hits were found at.
+    """
+    click_offsets, clicks, query_offsets, queries = sessions
+    num_sessions = len(query_offsets) - 1
+    num_codes = max([0] + [int(codes.max()) + 1 for codes in (hit_codes, clicks) if codes.size])
+    # Pack (session, click) into one integer. Clicks are sorted within
+    # each session, so the packed click keys are sorted and membership of
+    # every hit in its session's clicks is a single searchsorted.
+    query_sessions = np.repeat(np.arange(num_sessions), np.diff(query_offsets))
+    click_sessions = np.repeat(np.arange(num_sessions), np.diff(click_offsets))
+    click_keys = click_sessions * num_codes + clicks
+    hits = hit_codes[queries]
+    clicked = np.zeros(hits.shape, dtype=bool)
+    if len(click_keys):
+        hit_keys = query_sessions[:, None] * num_codes + hits
+        found = np.searchsorted(click_keys, hit_keys)
+        np.minimum(found, len(click_keys) - 1, out=found)
+        clicked = (click_keys[found] == hit_keys) & (hits >= 0)
+
+    weights = np.power.outer(factors, np.arange(hit_codes.shape[1]))
+    session_scores = np.zeros((num_sessions, len(factors)))
+    np.add.at(session_scores, query_sessions, clicked.dot(weights.T))
+    num_queries = np.diff(query_offsets)
+    if (num_queries == 0).any():
+        # sometimes we get a session with clicks but no queries...
+        # might want to filter those at the sql level
+        LOG.debug("%d sessions have no queries...", (num_queries == 0).sum())
+    session_scores /= np.maximum(num_queries, 1)[:, None]
+    return session_scores, clicked.sum(axis=0)
+
+
+# Factors and hits shared by the worker processes of PaulScore
+_paul_score_worker_args = None
+
+
+def _init_paul_score_worker(factors, hit_codes):
+    global _paul_score_worker_args
+    _paul_score_worker_args = (factors, hit_codes)
+
+
+def _paul_score_worker(sessions):
+    factors, hit_codes = _paul_score_worker_args
+    return _paul_score_sessions(factors, hit_codes, sessions)
+
+
 # Formula from talk given by Paul Nelson at ElasticON 2016
+def _pool_context():
+    """Multiprocessing context that doesn't fork the calling process
+
+    Scoring can run while search threads are still alive, and forking a
+    threaded process can leave the workers deadlocked on a lock, such as
+    the logging lock, that another thread held at the time of the fork.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
 class PaulScore:
-    def __init__(self, rows, options):
+    COLUMNS = ['session', 'click', 'query']
 
-        self._sessions = self._extract_sessions(rows)
-        self.queries = set([q for s in self._sessions.values() for q in s['queries']])
+    def __init__(self, rows, options):
+        if not isinstance(rows, pd.DataFrame):
+            rows = pd.DataFrame.from_records(rows, columns=self.COLUMNS)
+        self._extract_sessions(rows)
+        self.queries = self._query_strings.tolist()
         self.factors = options['factor']
         if type(self.factors) != list:
             self.factors = [self.factors]
+        # Number of processes to score sessions with, 0 uses every core
+        self.processes = int(options.get('processes', 1)) or multiprocessing.cpu_count()
 
     def name(self, factor=None):
         if factor is None:
@@ -442,56 +974,92 @@ class PaulScore:
         return "PaulScore@%.2f" % (factor)
 
     def report(self):
-        num_clicks = sum([len(s['clicks']) for s in self._sessions.values()])
         print('Loaded %d sessions with %d clicks and %d unique queries' %
-              (len(self._sessions), num_clicks, len(self.queries)))
-
-    def _extract_sessions(self, rows):
-        def not_null(x):
-            return x != 'NULL'
-
-        sessions = {}
-        rows = sorted(rows)
-        for sessionId, group in itertools.groupby(rows, operator.itemgetter(0)):
-            _, clicks, queries = zip(*group)
-            sessions[sessionId] = {
-                'clicks': set(filter(not_null, clicks)),
-                'queries': set(filter(not_null, [q.strip() for q in queries])),
-            }
-        return sessions
-
-    def _query_score(self, factor, sessionId, query):
-        try:
-            hits = self.results[query]
-        except KeyError:
-            LOG.debug("missing query? oops...")
-            return 0.
-        clicks = self._sessions[sessionId]['clicks']
-        score = 0.
-        for hit, pos in zip(hits, itertools.count()):
-            if hit['docId'] in clicks:
-                score += factor ** pos
-                self.histogram.add(pos)
-        return score
-
-    def _session_score(self, factor, sessionId):
-        queries = self._sessions[sessionId]['queries']
-        if len(queries) == 0:
-            # sometimes we get a session with clicks but no queries...
-            # might want to filter those at the sql level
-            LOG.debug("session has no queries...")
-            return 0.
-        scorer = functools.partial(self._query_score, factor, sessionId)
-        return sum(map(scorer, queries))/len(queries)
+              (len(self._session_ids), len(self._clicks), len(self.queries)))
+
+    @classmethod
+    def from_columns(cls, columns, options):
+        """PaulScore of (sessionId, click, query) columns
+
+        columns are as returned by CachedQuery.fetch_columns. Numeric
+        columns are used as the memory mapped arrays they are, only
+        string columns are decoded.
+        """
+        df = pd.DataFrame(dict(
+            (name, column.tolist() if isinstance(column, StringColumn) else column)
+            for name, column in zip(cls.COLUMNS, columns)), columns=cls.COLUMNS)
+        return cls(df, options)
+
+    def _extract_sessions(self, df):
+        """Load sessions from a DataFrame of session, click and query, modifying it
+
+        Session ids, clicked doc ids and queries are interned to integer
+        codes. The distinct clicks and queries of each session are held as
+        sorted code arrays, with session i at offsets[i]:offsets[i + 1].
+        """
+        df['session'], self._session_ids = pd.factorize(df['session'])
+        df['query'] = df['query'].str.strip()
+
+        # Missing values are 'NULL' when read from hive, None from db api
+        # providers
+        clicks = df.loc[df['click'].notna() & (df['click'] != 'NULL'), ['session', 'click']].drop_duplicates()
+        click_codes, self._doc_ids = pd.factorize(clicks['click'])
+        self._doc_ids = pd.Index(self._doc_ids)
+        self._click_offsets, self._clicks = _csr(
+            clicks['session'].values, click_codes, len(self._session_ids))
+
+        queries = df.loc[df['query'].notna() & (df['query'] != 'NULL'), ['session', 'query']].drop_duplicates()
+        query_codes, self._query_strings = pd.factorize(queries['query'])
+        self._query_offsets, self._queries = _csr(
+            queries['session'].values, query_codes, len(self._session_ids))
+
+    def _hit_codes(self, results):
+        """Click codes of the hits of every query, -1 for hits never clicked"""
+        index = ResultIndex.of(results)
+        doc_codes, doc_ids = index.codes('docId')
+        click_codes = self._doc_ids.get_indexer(doc_ids)[doc_codes]
+        k = int(index.hit_ranks.max()) + 1 if len(index.hit_ranks) else 0
+        # One extra row of -1 for queries missing from the results
+        hit_codes = np.vstack([index.top_k(click_codes, k, -1), np.full((1, k), -1, dtype=np.int64)])
+        rows = index.query_index.get_indexer(self._query_strings)
+        if (rows < 0).any():
+            LOG.debug("missing %d queries? oops...", (rows < 0).sum())
+        return hit_codes[rows]
+
+    def _session_range(self, lo, hi):
+        click_lo, click_hi = self._click_offsets[lo], self._click_offsets[hi]
+        query_lo, query_hi = self._query_offsets[lo], self._query_offsets[hi]
+        return (self._click_offsets[lo:hi + 1] - click_lo, self._clicks[click_lo:click_hi],
+                self._query_offsets[lo:hi + 1] - query_lo, self._queries[query_lo:query_hi])
 
     def engine_score(self, results):
-        self.results = results
+        factors = np.array(self.factors, dtype=np.float64)
+        hit_codes = self._hit_codes(results)
+        num_sessions = len(self._session_ids)
+        if self.processes > 1 and num_sessions > 1:
+            # A few chunks per process to even out uneven sessions
+            bounds = np.linspace(0, num_sessions, min(num_sessions, self.processes * 4) + 1).astype(np.int64)
+            chunks = [self._session_range(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:])]
+            pool = _pool_context().Pool(self.processes, _init_paul_score_worker, (factors, hit_codes))
+            try:
+                partials = pool.map(_paul_score_worker, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            partials = [_paul_score_sessions(factors, hit_codes, self._session_range(0, num_sessions))]
+
+        # Chunks are contiguous ranges of sessions, in order
+        session_scores = np.vstack([partial_scores for partial_scores, _ in partials])
+        histogram = Histogram()
+        for _, positions in partials:
+            histogram.update({pos: count for pos, count in enumerate(positions.tolist()) if count > 0})
+
         scores = []
-        for factor in self.factors:
-            self.histogram = Histogram()
-            scorer = functools.partial(self._session_score, factor)
-            score = sum(map(scorer, self._sessions))/len(self._sessions)
-            scores.append(EngineScore(self.name(factor), score, self.histogram))
+        for i, factor in enumerate(self.factors):
+            per_session = pd.Series(session_scores[:, i], index=self._session_ids)
+            scores.append(EngineScore(self.name(factor), float(per_session.sum()) / num_sessions,
+                                      histogram, per_session))
         return EngineScoreSet(scores)
 
 
@@ -505,6 +1073,10 @@ class Histogram:
         else:
             self.data[value] = 1
 
+    def update(self, counts):
+        for value, count in counts.items():
+            self.data[value] = self.data.get(value, 0) + count
+
     def __str__(self):
         most_hits = max(self.data.values())
         scale = 1. / max(1, most_hits/40)
@@ -519,11 +1091,44 @@ class Histogram:
         return res
 
 
+def _bootstrap_means(values, num_samples, seed=0, chunk_size=10000000):
+    """Means of num_samples resamples, with replacement, of values
+
+    Resamples are drawn as a (samples x len(values)) matrix of indices, in
+    chunks of at most chunk_size indices to bound memory use.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rng = np.random.RandomState(seed)
+    means = np.empty(num_samples)
+    step = max(1, chunk_size // max(len(values), 1))
+    for start in xrange(0, num_samples, step):
+        end = min(start + step, num_samples)
+        means[start:end] = values[rng.randint(0, len(values), size=(end - start, len(values)))].mean(axis=1)
+    return means
+
+
+def _percentile_interval(means, confidence):
+    tail = (1. - confidence) / 2 * 100
+    return tuple(np.percentile(means, [tail, 100 - tail]).tolist())
+
+
+def bootstrap_interval(values, num_samples=1000, confidence=0.95, seed=0):
+    """Bootstrap confidence interval of the mean of values"""
+    if len(values) == 0:
+        return None
+    return _percentile_interval(_bootstrap_means(values, num_samples, seed), confidence)
+
+
 class EngineScore(object):
-    def __init__(self, name, score, histogram=None):
+    def __init__(self, name, score, histogram=None, per_query=None):
         self.name = name
         self.score = score
         self.histogram = histogram
+        # pandas Series of the scores averaged into score, indexed by query
+        # (or session), used for confidence intervals and paired differences
+        self.per_query = per_query
+        self.interval = None
+        self.confidence = None
 
     def name(self):
         return self.name
@@ -531,13 +1136,62 @@ class EngineScore(object):
     def score(self):
         return self.score
 
+    def bootstrap(self, num_samples=1000, confidence=0.95):
+        if self.per_query is not None:
+            self.interval = bootstrap_interval(self.per_query.values, num_samples, confidence)
+            self.confidence = confidence
+
     def output(self, verbose=True):
-        print('%s: %0.2f' % (self.name, self.score))
+        if self.interval is None:
+            print('%s: %0.2f' % (self.name, self.score))
+        else:
+            print('%s: %0.2f (%d%% CI %0.3f - %0.3f)' % (
+                self.name, self.score, round(self.confidence * 100), self.interval[0], self.interval[1]))
         if verbose and self.histogram is not None:
             print('Histogram:')
             print(str(self.histogram))
 
 
+class EngineScoreDiff(object):
+    """Paired difference between two EngineScores over their shared queries"""
+    def __init__(self, a, b, num_samples=1000, confidence=0.95):
+        self.name = a.name
+        a_scores, b_scores = a.per_query.align(b.per_query, join='inner')
+        diffs = (b_scores - a_scores).values
+        self.num_queries = len(diffs)
+        self.diff = float(diffs.mean()) if len(diffs) else 0.
+        self.confidence = confidence
+        self.interval = None
+        self.p_value = None
+        if len(diffs):
+            means = _bootstrap_means(diffs, num_samples)
+            self.interval = _percentile_interval(means, confidence)
+            # Two sided p-value of the mean difference being 0, from
+            # where 0 falls in the bootstrap distribution.
+            self.p_value = min(1., 2 * min((means <= 0).mean(), (means >= 0).mean()))
+
+    def output(self, verbose=True):
+        if self.interval is None:
+            print('%s: no shared queries to compare' % (self.name))
+            return
+        print('%s: %+0.4f (%d%% CI %+0.4f - %+0.4f, p=%0.3f, %d queries)' % (
+            self.name, self.diff, round(self.confidence * 100), self.interval[0],
+            self.interval[1], self.p_value, self.num_queries))
+
+
+def score_diff(a, b, num_samples=1000, confidence=0.95):
+    """Paired differences from scores a to scores b
+
+    a and b are the EngineScore or EngineScoreSet of the same scorer over
+    two result sets. Scores without per query values are skipped.
+    """
+    a_scores = a.scores if isinstance(a, EngineScoreSet) else [a]
+    b_scores = b.scores if isinstance(b, EngineScoreSet) else [b]
+    return EngineScoreSet([EngineScoreDiff(x, y, num_samples, confidence)
+                           for x, y in zip(a_scores, b_scores)
+                           if x.per_query is not None and y.per_query is not None])
+
+
 class EngineScoreSet(object):
     def __init__(self, scores):
         self.scores = scores
@@ -554,6 +1208,10 @@ class EngineScoreSet(object):
         # give them the first one
         return self.scores[0].score()
 
+    def bootstrap(self, num_samples=1000, confidence=0.95):
+        for score in self.scores:
+            score.bootstrap(num_samples, confidence)
+
     def output(self, verbose=True):
         for score in self.scores:
             score.output(verbose)
@@ -0,0 +1,62 @@
+import json
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+import pytest
+
+from relforge_engine_score.__main__ import sweep_sections, sweep_table
+from relforge_engine_score.scorers import EngineScore, EngineScoreSet
+
+
+def make_config(tmpdir, sweep, options=None):
+    config = configparser.ConfigParser()
+    config.add_section('settings')
+    config.set('settings', 'workDir', str(tmpdir))
+    config.add_section('test1')
+    config.set('test1', 'name', 'base')
+    config.set('test1', 'labHost', 'localhost')
+    config.set('test1', 'searchCommand', 'search')
+    if options is not None:
+        config.set('test1', 'config', json.dumps(options))
+    config.add_section('sweep')
+    config.set('sweep', 'grid', sweep)
+    return config
+
+
+def test_sweep_sections(tmpdir):
+    config = make_config(
+        tmpdir, '{"wgCirrusSearchRescoreWindowSize": [64, 128, 256], "wgCirrusSearchPhraseRescoreBoost": [1, 10]}',
+        {'wgCirrusSearchPhraseRescoreBoost': 5, 'wgCirrusSearchFoo': 'bar'})
+    sweep = sweep_sections(config)
+    assert len(sweep) == 6
+    names = set()
+    for section, params in sweep:
+        assert config.get(section, 'searchCommand') == 'search'
+        assert json.loads(config.get(section, 'config')) == dict(params, wgCirrusSearchFoo='bar')
+        names.add(config.get(section, 'name'))
+    # Every point gets its own work directory
+    assert len(names) == 6
+    assert sorted(p['wgCirrusSearchRescoreWindowSize'] for _, p in sweep) == [64, 64, 128, 128, 256, 256]
+
+
+def test_sweep_sections_invalid(tmpdir):
+    config = make_config(tmpdir, '{"wgCirrusSearchRescoreWindowSize": [64, 128}')
+    with pytest.raises(ValueError):
+        sweep_sections(config)
+
+
+def test_sweep_table(tmpdir):
+    config = make_config(tmpdir, '{"window": [64, 128]}')
+    sweep = sweep_sections(config)
+    engine_scores = {}
+    for section, params in sweep:
+        engine_scores[section] = EngineScoreSet([
+            EngineScore('nDCG@5', params['window'] / 1000.),
+            EngineScore('ERR@5', params['window'] / 100.),
+        ])
+    table = sweep_table(sweep, engine_scores)
+    assert list(table.columns) == ['window', 'nDCG@5', 'ERR@5']
+    assert table['nDCG@5'].tolist() == [0.064, 0.128]
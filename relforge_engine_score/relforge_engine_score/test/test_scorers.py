@@ -0,0 +1,390 @@
+from collections import Counter, defaultdict
+import math
+import random
+
+import numpy as np
+import pytest
+
+from relforge.columnar import columns_from_rows, load_table, save_table
+from relforge_engine_score.scorers import (
+    DCG, ERR, IDCG, MPC, MRR_AC, MPCBuilder, MultiScorer, PaulScore, ResultIndex, bootstrap_interval,
+    calc_mpc, init_scorer, nDCG, score_diff)
+
+
+def make_data(num_queries=50, seed=0):
+    r = random.Random(seed)
+    rows = []
+    results = {}
+    for i in range(num_queries):
+        query = 'query %d' % (i)
+        titles = ['title %d' % (j) for j in range(r.randint(0, 30))]
+        for title in r.sample(titles, len(titles) // 2):
+            rows.append((query, title, r.randint(0, 3)))
+        r.shuffle(titles)
+        results[query] = [{'docId': str(j), 'title': title} for j, title in enumerate(titles)]
+    # Results for a query without any relevance judgments
+    results['unjudged'] = [{'docId': '1', 'title': 'title 1'}]
+    return rows, results
+
+
+def reference_dcg(relevance, query, hits, k):
+    dcg = 0
+    for i, hit in enumerate(hits[:k]):
+        dcg += (math.pow(2, relevance.get(query, {}).get(hit['title'], 0)) - 1) / math.log(i + 2, 2)
+    return dcg
+
+
+def reference_ideal(relevance, query):
+    return [{'title': title} for title, _ in
+            sorted(relevance[query].items(), key=lambda x: x[1], reverse=True)]
+
+
+def reference_err(relevance, query, hits, k, max_rel):
+    p = 1
+    err = 0
+    for i, hit in enumerate(hits[:k]):
+        R = (math.pow(2, relevance.get(query, {}).get(hit['title'], 0)) - 1) / max_rel
+        err += p * R / (i + 1)
+        p *= 1 - R
+    return err
+
+
+def relevance_of(rows):
+    relevance = {}
+    for query, title, score in rows:
+        relevance.setdefault(query, {})[title] = score
+    return relevance
+
+
+@pytest.mark.parametrize('k', [1, 3, 20, 50])
+def test_dcg(k):
+    rows, results = make_data()
+    relevance = relevance_of(rows)
+    dcg = DCG(rows, {'k': k})
+    expected = sum(reference_dcg(relevance, q, hits, k) for q, hits in results.items()) / len(results)
+    assert dcg.engine_score(results).score == pytest.approx(expected)
+
+    idcg = IDCG(rows, {'k': k})
+    expected = sum(reference_dcg(relevance, q, reference_ideal(relevance, q), k)
+                   for q in relevance) / len(relevance)
+    assert idcg.engine_score(results).score == pytest.approx(expected)
+
+
+def test_ndcg():
+    ks = [1, 3, 5, 10, 20]
+    rows, results = make_data()
+    relevance = relevance_of(rows)
+    scorer = nDCG(iter(rows), {'k': ks})
+    # The ideal DCGs are computed up front for every k
+    assert sorted(scorer.idcg.idcgs) == ks
+    scores = scorer.engine_score(results).scores
+    assert [s.name for s in scores] == ['nDCG@%d' % (k) for k in ks]
+    for k, score in zip(ks, scores):
+        ndcgs = []
+        for query, hits in results.items():
+            if query not in relevance:
+                continue
+            idcg = reference_dcg(relevance, query, reference_ideal(relevance, query), k)
+            ndcgs.append(reference_dcg(relevance, query, hits, k) / idcg if idcg > 0 else 0)
+        assert score.score == pytest.approx(sum(ndcgs) / len(ndcgs))
+
+
+def test_err():
+    ks = [1, 3, 5, 10, 20]
+    rows, results = make_data()
+    relevance = relevance_of(rows)
+    scores = ERR(rows, {'k': ks, 'max_relevance_scale': 3}).engine_score(results).scores
+    assert [s.name for s in scores] == ['ERR@%d' % (k) for k in ks]
+    for k, score in zip(ks, scores):
+        expected = sum(reference_err(relevance, q, hits, k, 8) for q, hits in results.items()) / len(results)
+        assert score.score == pytest.approx(expected)
+
+
+def make_clicks(seed=0):
+    r = random.Random(seed)
+    words = ['foo', 'food', 'bar', 'barn', u'b\xe4r', 'f']
+    return [(r.choice(words) + r.choice(['', ' ', 'x']), r.randint(1, 10)) for _ in range(200)]
+
+
+def test_mrr_ac():
+    clicks = make_clicks()
+    scorer = MRR_AC(iter(clicks), {})
+    prefixes = set(q[:i + 1] for q, _ in clicks for i in range(len(q)))
+    assert sorted(scorer.queries) == sorted(prefixes)
+
+    r = random.Random(1)
+    results = {prefix: [{'docId': str(page_id), 'title': 'x'} for page_id in r.sample(range(1, 11), 5)]
+               for prefix in prefixes}
+    expected = 0
+    for query, page_id in clicks:
+        query_score = []
+        for i in range(len(query)):
+            ranks = {hit['docId']: j for j, hit in enumerate(results[query[:i + 1]], 1)}
+            query_score.append(1. / ranks[str(page_id)] if str(page_id) in ranks else 0.)
+        expected += sum(query_score) / len(query_score)
+    assert scorer.engine_score(results).score == pytest.approx(expected / len(clicks))
+
+    del results['foo']
+    with pytest.raises(Exception):
+        scorer.engine_score(results)
+
+
+def test_mrr_ac_memory():
+    import tracemalloc
+    r = random.Random(0)
+    words = [''.join(r.choice('abcdefgh') for _ in range(r.randint(3, 9))) for _ in range(500)]
+    clicks = [(' '.join(r.choice(words) for _ in range(r.randint(1, 3))), r.randint(1, 10 ** 6))
+              for _ in range(20000)]
+
+    tracemalloc.start()
+    try:
+        # What MRR_AC used to hold: page ids per query, and every prefix
+        queries = defaultdict(list)
+        for query, page_id in clicks:
+            queries[query].append(int(page_id))
+        prefixes = set(q[:i + 1] for q in queries for i in range(len(q)))
+        baseline = tracemalloc.get_traced_memory()[0]
+        del queries, prefixes
+        start = tracemalloc.get_traced_memory()[0]
+        scorer = MRR_AC(iter(clicks), {})
+        used = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    assert scorer._num_clicks == len(clicks)
+    assert used < baseline / 2
+
+
+@pytest.mark.parametrize('top_k,memory_budget,buffer_size', [
+    (None, 1 << 30, 1000000),
+    (3, 1 << 30, 1000000),
+    # Spill to disk every few queries
+    (None, 100, 50),
+    (2, 100, 50),
+])
+def test_calc_mpc(monkeypatch, top_k, memory_budget, buffer_size):
+    monkeypatch.setattr(MPCBuilder, 'BUFFER_SIZE', buffer_size)
+    queries = defaultdict(list)
+    for query, page_id in make_clicks():
+        queries[query].append(str(page_id))
+    votes = defaultdict(Counter)
+    for query, page_ids in queries.items():
+        for i in range(len(query)):
+            votes[query[:i + 1]].update(page_ids)
+
+    model = calc_mpc(queries, top_k, memory_budget)
+    assert sorted(model) == sorted(votes)
+    for prefix, counts in votes.items():
+        ranked = sorted(model[prefix], key=model[prefix].get)
+        assert [model[prefix][page_id] for page_id in ranked] == list(range(1, len(ranked) + 1))
+        expected = sorted(counts.values(), reverse=True)
+        if top_k is None:
+            assert set(ranked) == set(counts)
+        else:
+            expected = expected[:top_k]
+        assert [counts[page_id] for page_id in ranked] == expected
+
+
+def test_mpc():
+    clicks = make_clicks()
+    scorer = MPC(iter(clicks), {'test_train_split': 0.8})
+    model = dict((prefix, scorer.model[prefix]) for prefix in scorer.model)
+    assert len(model) == len(scorer.model)
+    expected = []
+    for query, page_ids in scorer.test_set.items():
+        for page_id in page_ids:
+            query_score = list(MRR_AC.score_query(model, query, page_id, allow_missing=True))
+            expected.append(sum(query_score) / len(query_score))
+    assert scorer.engine_score({}).score == pytest.approx(sum(expected) / len(expected))
+    assert 'zzz' not in scorer.model
+    assert scorer.model.rank('f', 'no such page') is None
+    with pytest.raises(KeyError):
+        scorer.model.rank('zzz', '1')
+
+
+def test_calc_mpc_memory():
+    import tracemalloc
+    r = random.Random(0)
+    words = [''.join(r.choice('abcdefgh') for _ in range(r.randint(3, 9))) for _ in range(500)]
+    queries = defaultdict(list)
+    for _ in range(5000):
+        queries[' '.join(r.choice(words) for _ in range(r.randint(1, 3)))].append(str(r.randint(1, 1000)))
+
+    tracemalloc.start()
+    try:
+        # The dict of prefix to dict of page id to rank calc_mpc used to return
+        votes = defaultdict(Counter)
+        for query, page_ids in queries.items():
+            for i in range(len(query)):
+                votes[query[:i + 1]].update(page_ids)
+        reference = dict((prefix, dict((page_id, i) for i, (page_id, _) in enumerate(counts.most_common(), 1)))
+                         for prefix, counts in votes.items())
+        del votes
+        baseline = tracemalloc.get_traced_memory()[0]
+        del reference
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        model = calc_mpc(queries)
+        used = tracemalloc.get_traced_memory()[0] - start
+        peak = tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+    assert len(model) > 0
+    assert used < baseline / 4
+    assert peak < baseline
+
+
+def make_sessions(seed=0):
+    r = random.Random(seed)
+    rows = []
+    for session in range(100):
+        for _ in range(r.randint(1, 4)):
+            click = str(r.randint(1, 10)) if r.random() > 0.2 else 'NULL'
+            query = r.choice(['foo', 'bar', 'baz ', 'missing']) if r.random() > 0.1 else 'NULL'
+            rows.append(('session %d' % (session), click, query))
+    results = {query: [{'docId': str(page_id), 'title': 'x'} for page_id in r.sample(range(1, 11), 5)]
+               for query in ['foo', 'bar', 'baz']}
+    return rows, results
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_paul_score(processes):
+    factors = [0.1, 0.5, 0.9]
+    rows, results = make_sessions()
+    scorer = PaulScore(rows, {'factor': factors, 'processes': processes})
+    scores = scorer.engine_score(results).scores
+    assert [s.name for s in scores] == ['PaulScore@%.2f' % (f) for f in factors]
+
+    sessions = defaultdict(lambda: (set(), set()))
+    for session, click, query in rows:
+        clicks, queries = sessions[session]
+        if click != 'NULL':
+            clicks.add(click)
+        if query != 'NULL':
+            queries.add(query.strip())
+    positions = Counter()
+    for factor, score in zip(factors, scores):
+        expected = 0
+        for clicks, queries in sessions.values():
+            if not queries:
+                continue
+            session_score = 0
+            for query in queries:
+                for pos, hit in enumerate(results.get(query, [])):
+                    if hit['docId'] in clicks:
+                        session_score += factor ** pos
+                        positions[pos] += 1
+            expected += session_score / len(queries)
+        assert score.score == pytest.approx(expected / len(sessions))
+    assert scores[0].histogram.data == {pos: count // len(factors) for pos, count in positions.items()}
+
+
+def test_paul_score_none_values():
+    results = {'q': [{'docId': '1', 'title': 'x'}, {'docId': '2', 'title': 'y'}]}
+    scorer = PaulScore([('s1', '1', 'q'), ('s2', '1', None)], {'factor': 0.5})
+    assert scorer.engine_score(results).scores[0].score == pytest.approx(0.5)
+
+    # None is missing like 'NULL', in both clicks and queries
+    rows, results = make_sessions()
+    expected = PaulScore(rows, {'factor': 0.5}).engine_score(results).scores[0].score
+    rows = [tuple(None if value == 'NULL' else value for value in row) for row in rows]
+    assert PaulScore(rows, {'factor': 0.5}).engine_score(results).scores[0].score == pytest.approx(expected)
+
+
+def test_init_scorer_reads_columns(tmpdir, mocker):
+    rows, results = make_sessions()
+    clicks = make_clicks()
+    query = mocker.patch('relforge_engine_score.scorers.CachedQuery').return_value
+    query.scoring_config = [
+        {'algorithm': 'PaulScore', 'options': {'factor': [0.5]}},
+        {'algorithm': 'PaulScore', 'options': {'factor': [0.9]}},
+    ]
+    path = str(tmpdir.join('table'))
+    save_table(path, columns_from_rows(rows))
+    # Each scorer reads the same memory mapped columns
+    query.fetch_columns.return_value = load_table(path)
+    scorer = init_scorer(None)
+    for factor, paul_score in zip([0.5, 0.9], scorer.scorers):
+        expected = PaulScore(rows, {'factor': [factor]}).engine_score(results).scores[0].score
+        assert paul_score.engine_score(results).scores[0].score == pytest.approx(expected)
+
+    save_table(path, columns_from_rows(clicks))
+    query.fetch_columns.return_value = load_table(path)
+    query.scoring_config = {'algorithm': 'MRR', 'options': {}}
+    mrr = init_scorer(None)
+    assert sorted(mrr.queries) == sorted(MRR_AC(clicks, {}).queries)
+
+
+def test_result_index():
+    results = {
+        'foo': [{'docId': '1', 'title': 'A'}, {'docId': '2', 'title': 'B'}, {'docId': '1', 'title': 'A'}],
+        'bar': [],
+        'baz': [{'docId': '2', 'title': 'B'}],
+    }
+    index = ResultIndex(results)
+    assert index.hit_rows.tolist() == [0, 0, 0, 2]
+    assert index.hit_ranks.tolist() == [0, 1, 2, 0]
+    assert index.doc_ranks == {'foo': {'1': 1, '2': 2}, 'bar': {}, 'baz': {'2': 1}}
+    values = index.hit_values(['foo', 'baz', 'missing', 'foo'], ['A', 'B', 'A', 'C'], [3, 2, 1, 1])
+    assert values.tolist() == [3, 0, 3, 2]
+    assert index.top_k(values, 2).tolist() == [[3, 0], [0, 0], [2, 0]]
+    assert ResultIndex.of(index) is index
+
+
+def test_result_index_null_titles():
+    results = {
+        'a': [{'docId': '1', 'title': 'T'}],
+        'b': [{'docId': '2', 'title': None}],
+    }
+    values = ResultIndex(results).hit_values(['a'], ['T'], [3])
+    assert values.tolist() == [3, 0]
+    dcgs = DCG([('a', 'T', 3)], {'k': 5}).engine_score(results)
+    assert dcgs.per_query.to_dict() == {'a': 7.0, 'b': 0.0}
+
+
+def test_dcg_null_judgment_title():
+    results = {'q': [{'docId': '1', 'title': 'A'}, {'docId': '2', 'title': 'B'}]}
+    dcgs = DCG([('q', None, 0), ('q', 'B', 3)], {'k': 5}).engine_score(results)
+    assert dcgs.per_query.to_dict() == {'q': pytest.approx(7 / math.log(3, 2))}
+
+
+def test_multi_scorer():
+    rows, results = make_data()
+    sessions, _ = make_sessions()
+    scorers = [
+        nDCG(rows, {'k': [1, 5, 20]}),
+        ERR(rows, {'k': [3, 10], 'max_relevance_scale': 3}),
+        PaulScore(sessions, {'factor': [0.5, 0.9]}),
+    ]
+    expected = [s.score for scorer in scorers for s in scorer.engine_score(results).scores]
+    scores = MultiScorer(scorers).engine_score(results).scores
+    assert [s.score for s in scores] == pytest.approx(expected)
+
+
+def test_bootstrap_interval():
+    values = np.random.RandomState(0).normal(1, 1, 400)
+    lo, hi = bootstrap_interval(values, 4000)
+    # Standard error is 0.05, so a 95% interval is about +-0.1
+    assert lo < values.mean() < hi
+    assert hi - lo == pytest.approx(0.2, rel=0.15)
+    assert bootstrap_interval([]) is None
+
+
+def test_score_diff():
+    rows, results = make_data(200)
+    scorer = nDCG(rows, {'k': [5, 20]})
+    a = scorer.engine_score(results)
+    a.bootstrap(500)
+    assert all(s.interval[0] <= s.score <= s.interval[1] for s in a.scores)
+
+    # Swapping the first two hits of one query only changes that query
+    changed = dict(results)
+    query = next(q for q, hits in results.items() if len(hits) > 2)
+    changed[query] = results[query][1::-1] + results[query][2:]
+    diffs = score_diff(a, scorer.engine_score(changed)).scores
+    assert [d.name for d in diffs] == ['nDCG@5', 'nDCG@20']
+    for d, before, after in zip(diffs, a.scores, scorer.engine_score(changed).scores):
+        assert d.diff == pytest.approx(after.score - before.score)
+        assert d.p_value > 0.05
+
+    same = score_diff(a, a).scores[0]
+    assert same.diff == 0 and same.interval == (0, 0)
@@ -1,6 +1,8 @@
 from setuptools import setup
 
 requirements = [
+    'numpy',
+    'pandas',
     'relforge',
 ]
 
@@ -0,0 +1,47 @@
+# compare.py - compare two relevance lab query runs in a single pass
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+# http://www.gnu.org/copyleft/gpl.html
+
+import os
+
+from relforge_relevance import jsondiff, relcomp
+from relforge_relevance.utils import iterate_result_pairs
+
+
+def compare(file1, file2, target_dir, printnum=20, key='docId',
+            bwiki='', dwiki='', bexplain='', dexplain=''):
+    """Generate the diff pages and metric report for two result files
+
+    Does the same work as running jsondiff.py into target_dir/diffs and
+    relcomp.py into target_dir, but decodes each pair of results only
+    once and shares it between the two.
+    """
+    diff_dir = target_dir + '/diffs/'
+    if not os.path.exists(diff_dir):
+        os.makedirs(diff_dir)
+    relcomp.set_target_dir(target_dir)
+    metrics = relcomp.make_metrics(printnum)
+
+    diff_count = 0
+    errors = {}
+    for aresults, bresults in iterate_result_pairs(file1, file2):
+        diff_count += 1
+        # Measure first, writing the diff page modifies the results
+        relcomp.measure_pair(metrics, errors, aresults, bresults, diff_count)
+        jsondiff.write_diff(diff_dir, diff_count, aresults, bresults, file1, file2, key,
+                            bwiki, dwiki, bexplain, dexplain)
+
+    relcomp.print_report(diff_count, file1, file2, metrics, errors)
@@ -30,13 +30,11 @@
 
 import argparse
 import difflib
-import json
 import os
 import sys
-from itertools import zip_longest
 import urllib
 import urllib.parse
-from relforge_relevance.utils import asciify
+from relforge_relevance.utils import asciify, iterate_result_pairs
 
 
 def add_nums_to_results(results):
@@ -445,6 +443,34 @@ function alignAllDivs() {
 '''
 
 
+def write_diff(target_dir, diff_count, aresults, bresults, file1, file2, key='docId',
+               bwiki='', dwiki='', bexplain='', dexplain=''):
+    """Write the html diff page for one pair of decoded results
+
+    Note that aresults and bresults are modified along the way.
+    """
+    # munge lucene explanation
+    munge_explanation(aresults)
+    munge_explanation(bresults)
+
+    apageids = extract_ids(aresults, key)
+    bpageids = extract_ids(bresults, key)
+
+    s = difflib.SequenceMatcher(None, apageids, bpageids)
+
+    amap, bmap = make_map(apageids, bpageids)
+
+    add_diffs(aresults, bresults, key)
+
+    with open(target_dir + 'diff' + repr(diff_count) + '.html', 'w') as diff_file:
+        diff_file.writelines(html_head(s))
+        diff_file.writelines(html_results(aresults, amap, file1, key, wiki_url=bwiki,
+                                          explain_url=bexplain, baseline=True))
+        diff_file.writelines(html_results(bresults, bmap, file2, key, wiki_url=dwiki,
+                                          explain_url=dexplain, baseline=False))
+        diff_file.writelines(html_foot())
+
+
 def main():
     parser = argparse.ArgumentParser(description='line-by-line diff of JSON blobs',
                                      prog=sys.argv[0])
@@ -475,41 +501,10 @@ def main():
     if not os.path.exists(target_dir):
         os.makedirs(os.path.dirname(target_dir))
 
-    with open(file1) as a, open(file2) as b:
-        for aline, bline in zip_longest(a, b, fillvalue='{}'):
-            aline = aline.strip(' \t\n')
-            bline = bline.strip(' \t\n')
-            if aline == '':
-                aline = '{}'
-            if bline == '':
-                bline = '{}'
-            diff_count += 1
-            diff_file = open(target_dir + 'diff' + repr(diff_count) + '.html', 'w')
-
-            aresults = json.loads(aline)
-            bresults = json.loads(bline)
-
-            # munge lucene explanation
-            munge_explanation(aresults)
-            munge_explanation(bresults)
-
-            apageids = extract_ids(aresults, key)
-            bpageids = extract_ids(bresults, key)
-
-            s = difflib.SequenceMatcher(None, apageids, bpageids)
-
-            amap, bmap = make_map(apageids, bpageids)
-
-            add_diffs(aresults, bresults, key)
-
-            diff_file.writelines(html_head(s))
-            diff_file.writelines(html_results(aresults, amap, file1, key, wiki_url=args.bwiki,
-                                              explain_url=args.bexplain, baseline=True))
-            diff_file.writelines(html_results(bresults, bmap, file2, key, wiki_url=args.dwiki,
-                                              explain_url=args.dexplain, baseline=False))
-            diff_file.writelines(html_foot())
-
-            diff_file.close()
+    for aresults, bresults in iterate_result_pairs(file1, file2):
+        diff_count += 1
+        write_diff(target_dir, diff_count, aresults, bresults, file1, file2, key,
+                   args.bwiki, args.dwiki, args.bexplain, args.dexplain)
 
 
 if __name__ == "__main__":
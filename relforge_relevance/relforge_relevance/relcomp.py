@@ -24,7 +24,6 @@
 from __future__ import division
 
 import argparse
-import json
 import matplotlib.pyplot as plt
 import matplotlib.ticker as tick
 import numpy
@@ -33,10 +32,9 @@ import sys
 import textwrap
 
 from abc import ABCMeta, abstractmethod
-from itertools import zip_longest
 from random import shuffle
 
-from relforge_relevance.utils import asciify
+from relforge_relevance.utils import asciify, iterate_result_pairs
 
 target_path = ""
 image_dir = "images/"
@@ -369,7 +367,7 @@ def print_report(diff_count, file1, file2, myMetrics, errors):
                           "{}</b></font>\n".format(len(errors)))
         report_file.write(toggle_string())
         printed = 0
-        keylist = errors.keys()
+        keylist = list(errors.keys())
         shuffle(keylist)
         for e in keylist:
             report_file.write("&nbsp;&nbsp; <font color=red>ERROR</font> " +
@@ -506,23 +504,36 @@ def main():
     args = parser.parse_args()
 
     (file1, file2) = args.file
+    set_target_dir(args.dir)
+    myMetrics = make_metrics(int(args.printnum))
+
+    diff_count = 0
+    errors = {}
+
+    for ajson, bjson in iterate_result_pairs(file1, file2):
+        diff_count += 1
+        measure_pair(myMetrics, errors, ajson, bjson, diff_count)
+
+    print_report(diff_count, file1, file2, myMetrics, errors)
+
+
+def set_target_dir(dir):
+    """Point the report, and the charts it includes, at dir"""
     global target_path
     global image_path
-    target_path = args.dir + "/"
+    target_path = dir + "/"
     image_path = target_path + image_dir
-    printnum = int(args.printnum)
 
     if not os.path.exists(target_path):
         os.makedirs(os.path.dirname(target_path))
     if not os.path.exists(image_path):
         os.makedirs(os.path.dirname(image_path))
 
-    diff_count = 0
-    errors = {}
 
+def make_metrics(printnum=20):
     # set up metrics
     # TODO: make this configurable from the .ini file
-    myMetrics = [
+    return [
         QueryCount(),
         HitsWithinRange("Zero Results Rate", 0, 0, printnum=printnum),
         HitsWithinRange("Poorly Performing Percentage", 2, 0, printnum=printnum),
@@ -535,28 +546,15 @@ def main():
         TopNDiff(20, sorted=False, printnum=printnum, showstats=True)
         ]
 
-    with open(file1) as a, open(file2) as b:
-        for tuple in zip_longest(a, b, fillvalue="{}"):
-            (aline, bline) = tuple
-            aline = aline.strip(" \t\n")
-            bline = bline.strip(" \t\n")
-            if aline == "":
-                aline = "{}"
-            if bline == "":
-                bline = "{}"
-            ajson = json.loads(aline)
-            bjson = json.loads(bline)
-
-            diff_count += 1
 
-            if 'error' in ajson or 'error' in bjson:
-                errors[diff_count] = make_query_string(ajson, bjson)
-                continue
+def measure_pair(myMetrics, errors, ajson, bjson, index):
+    """Apply each metric to one pair of decoded results"""
+    if 'error' in ajson or 'error' in bjson:
+        errors[index] = make_query_string(ajson, bjson)
+        return
 
-            for m in myMetrics:
-                m.measure(ajson, bjson, diff_count)
-
-    print_report(diff_count, file1, file2, myMetrics, errors)
+    for m in myMetrics:
+        m.measure(ajson, bjson, index)
 
 
 if __name__ == "__main__":
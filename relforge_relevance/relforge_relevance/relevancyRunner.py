@@ -14,11 +14,15 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 # http://www.gnu.org/copyleft/gpl.html
 
+import itertools
+import re
+import shlex
 import sys
 import argparse
 from configparser import ConfigParser
 
 import relforge.runner
+import relforge_relevance.compare
 import shutil
 
 
@@ -30,43 +34,104 @@ def distributeGlobalSettings(config, globals, sections, settings):
                 config.set(sec, set, config.get(globals, set))
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Run relevance lab queries', prog=sys.argv[0])
-    parser.add_argument('-c', '--config', dest='config', help='Configuration file name',
-                        required=True)
-    args = parser.parse_args()
+def getTestSections(config):
+    """Names of the [testN] sections, in numeric order"""
+    sections = [s for s in config.sections() if re.match(r'^test\d+$', s)]
+    return sorted(sections, key=lambda s: int(s[len('test'):]))
 
-    config = ConfigParser()
-    config.readfp(open(args.config))
-    distributeGlobalSettings(config, 'settings', ['test1', 'test2'],
-                             ['queries', 'labHost', 'searchCommand', 'config',
-                              'wikiUrl', 'explainUrl', 'allowReuse'])
-    relforge.runner.checkSettings(config, 'settings', ['workDir', 'jsonDiffTool', 'metricTool'])
-    relforge.runner.checkSettings(config, 'test1', ['name', 'queries', 'labHost', 'searchCommand'])
-    relforge.runner.checkSettings(config, 'test2', ['name', 'queries', 'labHost', 'searchCommand'])
-    # The string 'true' is intentional, configparser option values must be strings.
-    # TODO: make some useful defaults here?
-    relforge.runner.defaults(config, 'test1', {'wikiUrl': '', 'explainUrl': '', 'allowReuse': 'true'})
-    relforge.runner.defaults(config, 'test2', {'wikiUrl': '', 'explainUrl': '', 'allowReuse': 'true'})
-
-    res1 = relforge.runner.runSearch(config, 'test1')
-    res2 = relforge.runner.runSearch(config, 'test2')
+
+def getComparisons(config, sections):
+    """(baseline, delta) pairs of sections to compare"""
+    mode = config.get('settings', 'comparisons') if config.has_option('settings', 'comparisons') else 'baseline'
+    if mode == 'pairwise':
+        return list(itertools.combinations(sections, 2))
+    elif mode == 'baseline':
+        baseline = config.get('settings', 'baseline') if config.has_option('settings', 'baseline') else sections[0]
+        if baseline not in sections:
+            raise ValueError("Baseline [%s] is not a test section" % (baseline))
+        return [(baseline, section) for section in sections if section != baseline]
+    raise ValueError("Unknown comparisons mode %s, expected baseline or pairwise" % (mode))
+
+
+def compareKey(config):
+    """Result key used to match results when comparing in process
+
+    byTitle matches by title rather than docId. Without it a jsonDiffTool
+    configured with -t/--bytitle is honoured, as before compareInProcess.
+    """
+    if config.has_option('settings', 'byTitle'):
+        by_title = config.getboolean('settings', 'byTitle')
+    elif config.has_option('settings', 'jsonDiffTool'):
+        tool_args = shlex.split(config.get('settings', 'jsonDiffTool'))
+        by_title = '-t' in tool_args or '--bytitle' in tool_args
+    else:
+        by_title = False
+    return 'title' if by_title else 'docId'
+
+
+def compare(config, config_path, baseline, delta, res1, res2):
     comparisonDir = "%s/comparisons/%s_%s" % (
             config.get('settings', 'workDir'),
-            relforge.runner.getSafeName(config.get('test1', 'name')),
-            relforge.runner.getSafeName(config.get('test2', 'name')))
+            relforge.runner.getSafeName(config.get(baseline, 'name')),
+            relforge.runner.getSafeName(config.get(delta, 'name')))
     relforge.runner.refreshDir(comparisonDir)
-    shutil.copyfile(args.config, comparisonDir + "/config.ini")  # archive comparison config
+    shutil.copyfile(config_path, comparisonDir + "/config.ini")  # archive comparison config
+
+    if config.getboolean('settings', 'compareInProcess'):
+        print("COMPARING: [%s] vs [%s]" % (baseline, delta))
+        relforge_relevance.compare.compare(
+            res1, res2, comparisonDir, printnum=config.getint('settings', 'printNum'), key=compareKey(config),
+            bwiki=config.get(baseline, 'wikiUrl'), dwiki=config.get(delta, 'wikiUrl'),
+            bexplain=config.get(baseline, 'explainUrl'), dexplain=config.get(delta, 'explainUrl'))
+        return
 
     relforge.runner.runCommand("%s %s -w %s -W %s -e '%s' -E '%s' %s %s" % (
         config.get('settings', 'jsonDiffTool'),
         comparisonDir + "/diffs",
-        config.get('test1', 'wikiUrl'), config.get('test2', 'wikiUrl'),
-        config.get('test1', 'explainUrl'), config.get('test2', 'explainUrl'),
+        config.get(baseline, 'wikiUrl'), config.get(delta, 'wikiUrl'),
+        config.get(baseline, 'explainUrl'), config.get(delta, 'explainUrl'),
         res1, res2))
     relforge.runner.runCommand(
         "%s %s %s %s" % (config.get('settings', 'metricTool'), comparisonDir, res1, res2))
 
 
+def main():
+    parser = argparse.ArgumentParser(description='Run relevance lab queries', prog=sys.argv[0])
+    parser.add_argument('-c', '--config', dest='config', help='Configuration file name',
+                        required=True)
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.readfp(open(args.config))
+    sections = getTestSections(config)
+    distributeGlobalSettings(config, 'settings', sections,
+                             ['queries', 'labHost', 'searchCommand', 'config',
+                              'wikiUrl', 'explainUrl', 'allowReuse', 'shards', 'compression', 'backend',
+                              'esHosts', 'esIndex', 'queryDumps', 'msearchBatchSize'])
+    relforge.runner.defaults(config, 'settings', {'compareInProcess': 'true', 'printNum': '20'})
+    relforge.runner.checkSettings(config, 'settings', ['workDir'])
+    if not config.getboolean('settings', 'compareInProcess'):
+        relforge.runner.checkSettings(config, 'settings', ['jsonDiffTool', 'metricTool'])
+    if len(sections) < 2:
+        raise ValueError("At least two [testN] sections are required")
+    comparisons = getComparisons(config, sections)
+    for section in sections:
+        backend = relforge.runner.getBackend(config, section)
+        relforge.runner.checkSettings(config, section, ['name', 'queries'] + backend.required_settings)
+        # The string 'true' is intentional, configparser option values must be strings.
+        # TODO: make some useful defaults here?
+        relforge.runner.defaults(config, section, {'wikiUrl': '', 'explainUrl': '', 'allowReuse': 'true'})
+
+    # Every test runs once and concurrently, each comparison starts as soon
+    # as both of its result sets are available.
+    results = {}
+    concurrency = config.getint('settings', 'concurrency') if config.has_option('settings', 'concurrency') else None
+    for section, results_file in relforge.runner.runSearches(config, sections, concurrency=concurrency):
+        results[section] = results_file
+        for baseline, delta in comparisons:
+            if section in (baseline, delta) and baseline in results and delta in results:
+                compare(config, args.config, baseline, delta, results[baseline], results[delta])
+
+
 if __name__ == '__main__':
     main()
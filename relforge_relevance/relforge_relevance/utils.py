@@ -1,3 +1,26 @@
+import json
+from itertools import zip_longest
+
+from relforge.runner import openResults
+
+
+def iterate_result_pairs(file1, file2):
+    """Decode two result files line by line into (baseline, delta) pairs
+
+    When one file is shorter than the other it is padded with empty
+    results.
+    """
+    with openResults(file1) as a, openResults(file2) as b:
+        for aline, bline in zip_longest(a, b, fillvalue='{}'):
+            aline = aline.strip(' \t\n')
+            bline = bline.strip(' \t\n')
+            if aline == '':
+                aline = '{}'
+            if bline == '':
+                bline = '{}'
+            yield json.loads(aline), json.loads(bline)
+
+
 def asciify(the_string):
     if isinstance(the_string, (int, bool)):
         return str(the_string)